@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+"""Benchmark suite.
+
+Times each stage of conversion of the models in bench/models separately:
+preprocessing the model template, parsing it, deriving the exhaust
+velocities, computing the thrust tables, rendering the engine files and
+the whole conversion through main(). Stages are run repeatedly and the
+minimum and median wall time is reported.
+
+    bench.py run [-o results.json]
+    bench.py compare baseline.json results.json
+
+Compare flags stages that got slower than the baseline by more than the
+threshold and exits with non-zero status if there are any. For start-up
+time, see startup.py.
+"""
+
+from os.path import abspath, basename, dirname, join, splitext
+import argparse
+import contextlib
+import glob
+import io
+import json
+import numpy
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+here = dirname(abspath(__file__))
+sys.path.insert(0, dirname(here))
+
+import yaamatic
+from yaamatic import atmosphere, templates
+from yaamatic.model import Airplane
+from yaamatic.units import U
+
+def _time(fn, repeat):
+    times = []
+    for i in range(repeat):
+        # Tables reused from the previous repeat would not be computed
+        templates.clear_tables()
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return {'min': min(times), 'median': statistics.median(times)}
+
+def _preprocess(model):
+    with open(model, 'rb') as f:
+        return templates.load_stream(f, {})
+
+def _tables(engines):
+    for e in engines:
+        for fn in (e.idle_thrust_table, e.dry_thrust_table):
+            # Same grid as turbine_engine.genshi
+            for line in templates.table2(fn, templates.frange(0., 1.4, 14),
+                    range(-5000, 50001, 5000)):
+                pass
+
+def _v_ex(engines):
+    for e in engines:
+        e._invalidate()
+        e.get_v_ex()
+
+def _main(model, outdir):
+    argv = sys.argv
+    sys.argv = ['yaamatic', '--no-cache', '-j', '1', '-d', outdir, model]
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yaamatic.main()
+    finally:
+        sys.argv = argv
+
+def bench_atmosphere(repeat):
+    alts = [a * U.ft for a in range(-5000, 50001, 50)]
+    grid = U.Quantity(numpy.arange(-5000, 50001, 50), U.ft)
+    return {
+            'atmosphere/scalar': _time(
+                lambda: [atmosphere.getStdDensity(a) for a in alts], repeat),
+            'atmosphere/array': _time(
+                lambda: atmosphere.getStdDensity(grid), repeat),
+            }
+
+def bench_model(model, repeat):
+    name = splitext(basename(model))[0]
+    # No template cache, so the preprocessing includes compiling it
+    templates.xml_loader.cache = None
+    xml = _preprocess(model)
+    aircraft = Airplane.parse(xml)
+    engines = list(aircraft.engines_to_generte())
+    res = {
+            'preprocess': _time(lambda: _preprocess(model), repeat),
+            'parse': _time(lambda: Airplane.parse(xml), repeat),
+            'v_ex': _time(lambda: _v_ex(engines), repeat),
+            'tables': _time(lambda: _tables(engines), repeat),
+            'render': _time(lambda: [e.render_file() for e in engines], repeat),
+            }
+    with tempfile.TemporaryDirectory() as outdir:
+        res['main'] = _time(lambda: _main(model, outdir), repeat)
+    return {'{}/{}'.format(name, k): v for k, v in res.items()}
+
+def run(a):
+    results = bench_atmosphere(a.repeat)
+    for model in sorted(glob.glob(join(here, 'models', '*.xml'))):
+        results.update(bench_model(model, a.repeat))
+    for k, v in results.items():
+        print('{:24} {:10.3f} ms {:10.3f} ms'.format(k, v['min'] * 1000,
+            v['median'] * 1000))
+    if a.output is not None:
+        with open(a.output, 'w') as f:
+            json.dump({
+                'yaamatic': yaamatic.__version__,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'repeat': a.repeat,
+                'results': results,
+                }, f, indent=1, sort_keys=True)
+    return 0
+
+def compare(a):
+    with open(a.baseline) as f:
+        base = json.load(f)['results']
+    with open(a.current) as f:
+        cur = json.load(f)['results']
+    regressions = 0
+    for k in sorted(set(base) & set(cur)):
+        ratio = cur[k]['min'] / base[k]['min']
+        if ratio > 1 + a.threshold:
+            flag = 'SLOWER'
+            regressions += 1
+        elif ratio < 1 - a.threshold:
+            flag = 'faster'
+        else:
+            flag = ''
+        print('{:24} {:10.3f} ms {:10.3f} ms {:7.2f}x {}'.format(k,
+            base[k]['min'] * 1000, cur[k]['min'] * 1000, ratio, flag))
+    for k in sorted(set(base) ^ set(cur)):
+        print('{:24} only in {}'.format(k, 'baseline' if k in base else 'results'))
+    return 1 if regressions else 0
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    s = p.add_subparsers(dest='command')
+    s.required = True
+    r = s.add_parser('run', help="Run the benchmarks")
+    r.add_argument('-n', '--repeat', type=int, default=5,
+            help="Number of runs of each stage (default %(default)s)")
+    r.add_argument('-o', '--output',
+            help="Save results to OUTPUT as JSON")
+    r.set_defaults(fn=run)
+    c = s.add_parser('compare', help="Compare results with baseline")
+    c.add_argument('baseline')
+    c.add_argument('current')
+    c.add_argument('-t', '--threshold', type=float, default=0.1,
+            help="Relative slow-down flagged as regression (default %(default)s)")
+    c.set_defaults(fn=compare)
+    a = p.parse_args()
+    return a.fn(a)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+"""Start-up time benchmark.
+
+Runs yaamatic on the cheap code paths in fresh interpreters and reports
+median wall time of each. What keeps them cheap is not loading the modules
+they don't need, so that is checked too. Exits with non-zero status if
+a path loaded such module, or, with --limit, took longer than the limit.
+"""
+
+from os.path import abspath, dirname, join
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+here = dirname(abspath(__file__))
+model = join(here, 'models', 'single.xml')
+
+# name, arguments, modules that must not be loaded
+cases = (
+        # Relative paths are in temporary directory
+        ('help', ['--help'], ('pint', 'genshi', 'numpy', 'dexml')),
+        ('dump-model', ['--dump-model', model], ('pint', 'numpy', 'dexml')),
+        ('convert', ['--cache-dir', 'cache', model], ()),
+        ('convert-no-cache', ['--no-cache', model], ()),
+        )
+
+_probe = '''
+import sys
+sys.argv = ['yaamatic'] + {args!r}
+import yaamatic
+try:
+    yaamatic.main()
+except SystemExit:
+    pass
+loaded = [m for m in {forbidden!r} if m in sys.modules]
+if loaded:
+    sys.exit('loaded ' + ', '.join(loaded))
+'''
+
+def run(args, forbidden, cwd):
+    t = time.perf_counter()
+    p = subprocess.run([sys.executable, '-c',
+        _probe.format(args=args, forbidden=forbidden)],
+        cwd=cwd, env=dict(os.environ, PYTHONPATH=dirname(here)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    return time.perf_counter() - t, p.returncode, p.stderr.strip()
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('-n', '--repeat', type=int, default=10,
+            help="Number of runs of each case (default %(default)s)")
+    p.add_argument('--limit', type=float,
+            help="Fail if median time of a case exceeds LIMIT seconds")
+    a = p.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as cwd:
+        for name, args, forbidden in cases:
+            times = []
+            for i in range(a.repeat):
+                t, status, err = run(args, forbidden, cwd)
+                if status:
+                    print('{}: {}'.format(name, err), file=sys.stderr)
+                    failed = True
+                    break
+                times.append(t)
+            else:
+                median = statistics.median(times)
+                print('{:20} {:8.3f} s'.format(name, median))
+                if a.limit is not None and median > a.limit:
+                    failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -47,6 +47,7 @@ setup(
 
     install_requires=[
         'Genshi >= 0.7',
+        'NumPy',
         'Pint >= 0.6',
         ],
     )
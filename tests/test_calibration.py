@@ -0,0 +1,92 @@
+"""Fitting exhaust velocity and M₂ to thrust points."""
+
+import math
+
+import pytest
+
+from yaamatic import api
+from yaamatic import cache
+from yaamatic import model
+from yaamatic.model import Airplane, Calibration, _pressure_recovery_ratio
+
+RHO_REF = 1.225
+
+def points(v_ex, m2, *conditions):
+    """Thrust points of engine with v_ex and m2 at (M₀, ρ, v₀) conditions."""
+    return tuple((M0, rho, v0,
+            _pressure_recovery_ratio(M0, m2) * rho / RHO_REF * (1 - v0 / v_ex))
+        for M0, rho, v0 in conditions)
+
+cruise = (0.78, 0.38, 230.)
+climb = (0.5, 0.77, 160.)
+takeoff = (0.2, 1.2, 68.)
+
+def test_recovers_v_ex_and_m2():
+    c, = model.calibrate([(RHO_REF, True,
+        points(620., 0.35, cruise, climb, takeoff))])
+    assert c.v_ex == pytest.approx(620.)
+    assert c.m2 == pytest.approx(0.35)
+    assert max(abs(e) for e in c.residuals) < 1e-9
+
+def test_m2_dry_unless_fitted():
+    c, = model.calibrate([(RHO_REF, False, points(580., 0.5, cruise, climb))])
+    assert c.m2 == model._M2_dry
+    assert c.v_ex == pytest.approx(580.)
+
+def test_engines_fitted_together_independently():
+    a, b = model.calibrate([
+        (RHO_REF, True, points(620., 0.35, cruise, climb)),
+        (RHO_REF, False, points(540., 0.5, cruise))])
+    assert (a.v_ex, a.m2) == (pytest.approx(620.), pytest.approx(0.35))
+    assert (b.v_ex, b.m2) == (pytest.approx(540.), 0.5)
+
+def test_static_points_rejected():
+    c, = model.calibrate([(RHO_REF, True,
+        ((0., 1.225, 0., 1.), (0., 1.225, 0., 1.)))])
+    assert math.isnan(c.v_ex)
+    a = Airplane.parse('<airplane><jet thrust="1000 lbf" fit-m2="true">'
+            '<thrust-point thrust="1000 lbf" alt="0 ft" mach="0"/>'
+            '<thrust-point thrust="1000 lbf" alt="0 ft" mach="0"/>'
+            '</jet></airplane>')
+    with pytest.raises(ValueError):
+        a.jets[0].set_calibration(c)
+
+_model = ('<airplane><jet thrust="30000 lbf" fit-m2="true">'
+        '<thrust-point thrust="8600 lbf" alt="35000 ft" mach="0.78"/>'
+        '<thrust-point thrust="16400 lbf" alt="15000 ft" mach="0.5"/>'
+        '</jet><jet thrust="20000 lbf">'
+        '<thrust-point thrust="6000 lbf" alt="35000 ft" mach="0.78"/>'
+        '</jet></airplane>')
+
+@pytest.fixture
+def fits(monkeypatch):
+    """List of numbers of engines passed to each call of calibrate."""
+    res = []
+    calibrate = model.calibrate
+    def spy(data):
+        res.append(len(data))
+        return calibrate(data)
+    monkeypatch.setattr(model, 'calibrate', spy)
+    return res
+
+def test_cache_round_trip(tmp_path, fits):
+    c = cache.FileCache(str(tmp_path))
+    first = Airplane.parse(_model)
+    api.calibrate(first.jets, c)
+    assert fits == [2]
+    again = Airplane.parse(_model)
+    api.calibrate(again.jets, c)
+    assert fits == [2]
+    for a, b in zip(first.jets, again.jets):
+        assert b._calibration() == a._calibration()
+
+def test_calibration_kept_when_naming(fits):
+    a = Airplane.parse(_model)
+    c = Calibration(600., 0.45, (0., 0.))
+    a.jets[0].set_calibration(c)
+    a.jets[0].name = 'main'
+    engines = list(a.engines_to_generte())
+    assert a.jets[1].name == 'turbine1'
+    assert engines[0]._calibration() is c
+    assert engines[0]._thrust_params().v_ex == 600.
+    assert fits == [1]  # only the second jet, for its signature
@@ -0,0 +1,37 @@
+"""Naming of the jets and deduplication of their engines."""
+
+from yaamatic.model import Airplane
+
+def parse(*jets):
+    return Airplane.parse('<airplane>{}</airplane>'.format(''.join(
+        '<jet thrust="{} lbf"{}/>'.format(thrust,
+            '' if name is None else ' name="{}"'.format(name))
+        for thrust, name in jets)))
+
+def names(engines):
+    return [e.name for e in engines]
+
+def test_unnamed_duplicates_take_earlier_name():
+    a = parse((1000, None), (2000, None), (1000, None))
+    assert names(a.engines_to_generte()) == ['turbine1', 'turbine2']
+    assert names(a.jets) == ['turbine1', 'turbine2', 'turbine1']
+
+def test_unnamed_take_name_of_equal_named():
+    a = parse((1000, 'main'), (1000, None))
+    assert names(a.engines_to_generte()) == ['main']
+    assert names(a.jets) == ['main', 'main']
+
+def test_auto_names_skip_names_in_model():
+    a = parse((1000, None), (2000, 'turbine2'), (3000, None))
+    assert names(a.engines_to_generte()) == ['turbine1', 'turbine2',
+            'turbine3']
+
+def test_named_deduplicated_by_name():
+    a = parse((1000, 'main'), (2000, 'main'), (1000, 'other'))
+    assert names(a.engines_to_generte()) == ['main', 'other']
+
+def test_engine_map():
+    a = parse((1000, None), (2000, 'aux'), (1000, None))
+    list(a.engines_to_generte())
+    assert a.engine_map() == [(1, 'turbine1.xml'), (2, 'aux.xml'),
+            (3, 'turbine1.xml')]
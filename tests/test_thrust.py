@@ -0,0 +1,72 @@
+"""The thrust tables computed on SI floats against pint quantities."""
+
+import numpy
+import pytest
+
+from yaamatic import atmosphere
+from yaamatic.model import JetEngine, _pressure_recovery_ratio
+from yaamatic.units import U
+
+_jet = ('<jet x="0" y="0" z="0" mass="9000 lb" thrust="30000 lbf" {}>'
+        '<cruise thrust="6000 lbf" alt="35000 ft" speed="485 kt"/></jet>')
+
+engines = {
+        'plain': '',
+        'flat-to-temp': 'flat-to-temp="30 degC"',
+        'flat-to-alt': 'flat-to-alt="5000 ft"',
+        }
+
+mach = numpy.linspace(0, 1, 21)
+# Within the table, where numpy.interp does not clamp.
+alt = numpy.linspace(-2000, 100000, 103)
+
+def isa(a, field):
+    """Column field of the ISA table at altitudes a, interpolated directly in
+    atmosphere._data rather than by the atmosphere functions."""
+    alts = [d.a.m_as(U.m) for d in atmosphere._data]
+    unit = getattr(atmosphere._data[0], field).units
+    return numpy.interp(a.m_as(U.m), alts,
+            [getattr(d, field).m_as(unit) for d in atmosphere._data]) * unit
+
+def reference(e, M0, alt, M2, v_ex):
+    """JetEngine._thrust_ratio with every quantity in units."""
+    if e.flat_temp is not None:
+        rho_ref = isa(0 * U.ft, 'p') / (atmosphere.Rs_air
+                * e.flat_temp.to(U.K))
+    elif e.flat_alt is not None:
+        rho_ref = isa(e.flat_alt, 'rho')
+    else:
+        rho_ref = isa(0 * U.ft, 'rho')
+    rho = isa(alt, 'rho')
+    v_0 = M0 * (atmosphere.kappa * atmosphere.Rs_air * isa(alt, 'T')) ** 0.5
+    return (_pressure_recovery_ratio(M0, M2) * (rho/rho_ref)
+            * (v_ex - v_0)/v_ex).m_as(U.dimensionless)
+
+@pytest.fixture(params=sorted(engines))
+def engine(request):
+    return JetEngine.parse(_jet.format(engines[request.param]))
+
+def grid():
+    M, a = numpy.meshgrid(mach, alt, indexing='ij')
+    return M.ravel(), a.ravel()
+
+def test_dry_thrust_table(engine):
+    M, a = grid()
+    expected = reference(engine, M, a * U.ft, 0.5, engine.get_v_ex())
+    for m, h, r in zip(M, a, expected):
+        assert engine.dry_thrust_table(float(m), float(h)) == pytest.approx(
+                r, rel=1e-9, abs=1e-12)
+
+def test_idle_thrust_table(engine):
+    M, a = grid()
+    expected = 0.1 * reference(engine, M, a * U.ft, 0.2, engine.get_v_ex() / 3)
+    for m, h, r in zip(M, a, expected):
+        assert engine.idle_thrust_table(float(m), float(h)) == pytest.approx(
+                r, rel=1e-9, abs=1e-12)
+
+def test_table_arrays(engine):
+    # The whole grid at once, as templates.table2 evaluates it.
+    res = engine.dry_thrust_table(mach[:, None], alt[None, :])
+    M, a = grid()
+    expected = reference(engine, M, a * U.ft, 0.5, engine.get_v_ex())
+    numpy.testing.assert_allclose(res.ravel(), expected, rtol=1e-9, atol=1e-12)
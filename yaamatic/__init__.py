@@ -1,12 +1,18 @@
 ﻿"""Yaamatic JSBSim model generator."""
 
-from os.path import basename, dirname, join
 import argparse
+import collections
+import logging
+import os.path
 import re
 import sys
 
-from .model import Airplane
-from .templates import load_stream
+__version__ = '0.0.1'
+
+# The other modules load pint, genshi and numpy, which takes a while, so
+# they are only imported once it's clear they are needed.
+from . import cache
+from . import profiling
 
 _defRe = re.compile('([A-Za-z_][A-Za-z0-9_]*)(?:=(.*))?$')
 
@@ -21,11 +27,13 @@ def _Definition(string):
         raise ValueError('Definition must be identifier optionally '
                 +'followed by = and value')
 
-def main():
-    p = argparse.ArgumentParser(description=__doc__)
-    p.add_argument('model', type=argparse.FileType(mode='rb'), # FIXME: binary or not for genshi?
-            help="The input model template")
-    p.add_argument('-o', '--output', type=argparse.FileType(mode='wb'), # FIXME: binary or not for genshi?
+class _ManifestParser(argparse.ArgumentParser):
+    def error(self, message):
+        raise ValueError(message)
+
+def _model_arguments(p):
+    """Add the options that can be given for each model to parser p."""
+    p.add_argument('-o', '--output', type=str,
             help="The main output file. Default is derived from input model.")
     p.add_argument('-d', '--dir', type=str,
             help="The directory to write output to. Defaults to current "
@@ -38,30 +46,154 @@ def main():
             help="Define value that will be made available in the model "
                 +"template. Must be identifier, optionally followed by = "
                 +"and value")
+
+def main():
+    if sys.argv[1:2] == ['sweep']:
+        from . import sweep
+        return sweep.main(sys.argv[2:])
+    if sys.argv[1:2] == ['serve']:
+        from . import server
+        return server.main(sys.argv[2:])
+
+    p = argparse.ArgumentParser(description=__doc__,
+            epilog="Run '%(prog)s sweep --help' for exploring variants of "
+                +"an engine and '%(prog)s serve --help' for converting "
+                +"models sent over a pipe or socket.")
+    p.add_argument('model', nargs='*',
+            help="The input model templates. With more than one, they are "
+                +"converted in parallel and a summary is printed.")
+    _model_arguments(p)
+    p.add_argument('-m', '--manifest', type=argparse.FileType(mode='r'),
+            action='append', default=[],
+            help="File listing further models to convert, one per line, "
+                +"each optionally followed by -o, -d, --engines-dir and -D "
+                +"options for it. Definitions given on the command line "
+                +"apply to all models.")
+    p.add_argument('-j', '--jobs', type=int,
+            help="Number of models converted in parallel, or with single "
+                +"model, number of its engines generated in parallel. "
+                +"Defaults to the number of processors.")
+    p.add_argument('--cache-dir', type=str, default=cache.default_dir(),
+            help="Directory where generated engines and compiled "
+                +"templates are cached, so they are not generated again "
+                +"when nothing they depend on changes. Default is "
+                +"%(default)s.")
+    p.add_argument('--no-cache', action='store_true',
+            help="Don't use the cache.")
+    p.add_argument('--watch', action='store_true',
+            help="Keep running and convert the model again whenever it, "
+                +"a template it includes or the engine template changes.")
+    p.add_argument('--engine-library', type=str, metavar='DIR',
+            help="Generate the engines of all the models into DIR instead "
+                +"of their engines directories. Jets equal to an engine "
+                +"already there, from any model of this or an earlier run, "
+                +"are named after it and use its file; the names are kept in "
+                +"DIR/index.json.")
+    p.add_argument('--verify', type=float, metavar='TOL',
+            help="Check the thrust tables of the generated engines against "
+                +"the thrust functions between the breakpoints, and fail if "
+                +"the error of interpolating them exceeds TOL (in fraction "
+                +"of full thrust). With -v, the errors are reported.")
     p.add_argument('--dump-model', action='store_true',
             help='Print the preprocessed input model and stop.')
+    p.add_argument('-v', '--verbose', action='count', default=0,
+            help="Report progress on standard error. Repeat to also trace "
+                +"the derived engine parameters.")
+    p.add_argument('--profile', action='store_true',
+            help="Report time spent in each stage and engine and number of "
+                +"calls of the atmosphere and thrust functions on standard "
+                +"error.")
+    p.add_argument('--profile-dump', type=str, metavar='FILE',
+            help="Also save cProfile data of the main process to FILE, for "
+                +"reading with pstats. Implies --profile.")
     a = p.parse_args()
 
-    if a.dir is None:
+    logging.basicConfig(format='%(name)s: %(message)s',
+            level=logging.WARNING - 10 * a.verbose)
+
+    if a.profile or a.profile_dump is not None:
+        profiling.enable(a.profile_dump)
+    status = _run(p, a)
+    if profiling.enabled:
+        profiling.report(sys.stderr)
+    return status
+
+def _run(p, a):
+    cache.units_dir = None if a.no_cache else os.path.join(a.cache_dir, 'pint')
+    from . import batch
+    from . import templates
+
+    jobs = [batch.Job(m, dict(a.define), a.output, a.dir, a.engines_dir)
+            for m in a.model]
+    mp = _ManifestParser(prog='manifest', add_help=False)
+    mp.add_argument('model')
+    _model_arguments(mp)
+    for f in a.manifest:
+        try:
+            jobs.extend(batch.read_manifest(f, mp, dict(a.define)))
+        except ValueError as e:
+            p.error(str(e))
+
+    engine_cache = None if a.no_cache else cache.FileCache(a.cache_dir)
+    templates.xml_loader.cache = engine_cache
+    library = None
+    if a.engine_library is not None:
+        from .library import Library
+
+        library = Library(a.engine_library)
+
+    if not jobs:
+        p.error('no model given')
+    elif len(jobs) > 1 or a.manifest:
         if a.output is not None:
-            a.dir = dirname(a.output)
-        else:
-            a.dir = ''
-    if a.engines_dir is None:
-        a.engines_dir = join(a.dir, 'Engines')
-    # Note: If a.output is not defined, we can't define it yet, because it
-    # may be specified _inside_ the model!
+            p.error('--output is for single model; give it per model in a manifest')
+        if a.dump_model:
+            p.error('--dump-model is for single model')
+        if a.watch:
+            p.error('--watch is for single model')
+        dirs = collections.Counter(j.get_engines_dir() for j in jobs)
+        for d, n in dirs.items():
+            if n > 1 and library is None:
+                p.error("engines of several models would be written to '{}'; "
+                        "give per-model -d or --engines-dir in a manifest".format(d))
+        results = batch.run(jobs, a.jobs, engine_cache, a.verify, library)
+        if engine_cache is not None:
+            engine_cache.trim()
+        return 1 if batch.report(results, sys.stderr) else 0
 
-    model_xml = load_stream(a.model, dict(a.define))
+    job = jobs[0]
     if a.dump_model:
-        print(model_xml)
+        try:
+            print(batch.preprocess(job))
+        except OSError as e:
+            print('{}: {}: {}'.format(job.model, type(e).__name__, e),
+                    file=sys.stderr)
+            return 1
         return 0
 
-    aircraft = Airplane.parse(model_xml)
-
-    print(aircraft.render(pretty=True))#DEBUG#
+    if a.watch:
+        try:
+            batch.watch(job, sys.stdout, engine_cache, a.verify, library)
+        except ValueError as e:
+            p.error(str(e))
+        except KeyboardInterrupt:
+            pass
+        return 0
 
-    for e in aircraft.engines_to_generte():
-        e.generate(a.engines_dir)
+    try:
+        batch.convert(job, sys.stdout, a.jobs, engine_cache, verify=a.verify,
+                library=library)
+    except RuntimeError as e:
+        # The failures of the engines have been logged already.
+        print('{}: {}'.format(job.model, e), file=sys.stderr)
+        return 1
+    except OSError as e:
+        # E.g. missing model; reported like in batch mode.
+        print('{}: {}: {}'.format(job.model, type(e).__name__, e),
+                file=sys.stderr)
+        return 1
+    finally:
+        if engine_cache is not None:
+            engine_cache.trim()
 
     return 0
@@ -0,0 +1,385 @@
+"""Conversion as a library, without touching the disk.
+
+    from yaamatic import api
+
+    res = api.convert(open('model.xml', 'rb'), {'VARIANT': 'b'})
+    res.aircraft            # parsed aircraft, as str
+    res.engines             # {'turbine1.xml': b'<?xml…', …}
+
+Instead of collecting the outputs, convert can pass them to a Sink as
+they are produced; DirectorySink writes them to files like the command
+line does.
+"""
+
+from os.path import dirname, join
+import collections
+import concurrent.futures
+import contextlib
+import io
+import json
+import logging
+import os
+
+from . import profiling
+from . import templates
+
+_log = logging.getLogger(__name__)
+
+class Sink:
+    """Receiver of the outputs of convert.
+
+    The default implementation discards everything.
+    """
+
+    #: Whether to render the aircraft at all; it is skipped when False.
+    wants_aircraft = True
+    #: Whether engine takes the file as templates.stream too, which it is
+    #: then rendered from as it is written instead of all held in memory.
+    streams = False
+
+    def aircraft(self, text):
+        """Receive the parsed aircraft as str."""
+
+    def engine(self, name, data, key):
+        """Receive engine file name as bytes data, or stream if streams.
+
+        :key: is get_file_key of the engine it was generated from.
+        """
+
+    def has(self, name, key):
+        """Whether engine file name generated from key is already there.
+
+        Such engines are skipped altogether.
+        """
+        return False
+
+class MemorySink(Sink):
+    """Sink keeping the outputs in attributes aircraft_text and engines."""
+
+    def __init__(self):
+        self.aircraft_text = None
+        self.engines = collections.OrderedDict()
+
+    def aircraft(self, text):
+        self.aircraft_text = text
+
+    def engine(self, name, data, key):
+        self.engines[name] = data
+
+class DirectorySink(Sink):
+    """Sink writing engines to files in engines_dir.
+
+    The aircraft is written to file output, or printed to file object out
+    if output is None, or not rendered if neither is given. Files whose
+    content does not change are not touched.
+
+    With known, a dict of paths of engine files to the key of the engine
+    they were generated from, engines whose file is there with the same key
+    are skipped. The written ones are added to it.
+
+    Engines rendered here rather than taken from cache or from other
+    processes are streamed into their files.
+    """
+
+    streams = True
+
+    def __init__(self, engines_dir, output=None, out=None, known=None):
+        self.engines_dir = engines_dir
+        self.output = output
+        self.out = out
+        self.known = known
+        self.wants_aircraft = output is not None or out is not None
+
+    def aircraft(self, text):
+        if self.output is None:
+            print(text, file=self.out)
+        else:
+            if dirname(self.output):
+                os.makedirs(dirname(self.output), exist_ok=True)
+            with open(self.output, 'w', encoding='utf-8') as f:
+                print(text, file=f)
+
+    def engine(self, name, data, key):
+        f = join(self.engines_dir, name)
+        templates.write(f, data)
+        if self.known is not None:
+            self.known[f] = key
+
+    def has(self, name, key):
+        if self.known is None:
+            return False
+        f = join(self.engines_dir, name)
+        return self.known.get(f) == key and os.path.exists(f)
+
+class VerifyingSink(Sink):
+    """Sink checking the thrust tables of engine files passed to sink.
+
+    :engines: are the engines the files are generated from.
+    :tol: is the largest error allowed (see verify.check); ValueError is
+    raised for a file with larger one, after it has been passed on.
+
+    The errors are logged at info level.
+    """
+
+    def __init__(self, sink, engines, tol):
+        self.sink = sink
+        self.engines = {e.get_file_name(): e for e in engines}
+        self.tol = tol
+        self.wants_aircraft = sink.wants_aircraft
+
+    def aircraft(self, text):
+        self.sink.aircraft(text)
+
+    def engine(self, name, data, key):
+        from . import verify
+
+        self.sink.engine(name, data, key)
+        with profiling.stage('verify'):
+            errors = verify.check(self.engines[name], data)
+        for e in errors:
+            _log.info('%s: %s: max error %.3g, RMS %.3g', name, e.table,
+                    e.max, e.rms)
+        bad = [e.table for e in errors if e.max > self.tol]
+        if bad:
+            raise ValueError('error of {} exceeds {:g}'.format(
+                ', '.join(bad), self.tol))
+
+    def has(self, name, key):
+        return self.sink.has(name, key)
+
+Result = collections.namedtuple('Result', ['model', 'aircraft', 'engines'])
+Result.__doc__ = """Outputs of convert.
+
+:model: is the parsed model.Airplane.
+:aircraft: is it rendered as str, None if passed to a sink.
+:engines: is dict of engine file names to their content as bytes, empty if
+passed to a sink.
+"""
+
+def calibrate(jets, cache=None):
+    """Fit exhaust velocities of those jets that have thrust points.
+
+    They are all fitted together. With cache (a cache.FileCache), the
+    results are looked up in it first and the new ones added to it.
+    """
+    from .model import Calibration, calibrate
+
+    jets = [(i, j) for i, j in enumerate(jets, 1) if j.needs_calibration()]
+    keys = {}
+    pending = []
+    for i, j in jets:
+        if cache is not None:
+            keys[i] = cache.key('calibration', j.get_calibration_data())
+            data = cache.get(keys[i])
+            if data is not None:
+                v_ex, m2, residuals = json.loads(data.decode())
+                j.set_calibration(Calibration(v_ex, m2, tuple(residuals)))
+                continue
+        pending.append((i, j))
+    if pending:
+        fitted = calibrate([j.get_calibration_data() for i, j in pending])
+        for (i, j), c in zip(pending, fitted):
+            try:
+                j.set_calibration(c)
+            except ValueError as e:
+                raise ValueError('jet {}: {}'.format(i, e)) from e
+            if cache is not None:
+                cache.put(keys[i], json.dumps(c).encode())
+    for i, j in jets:
+        c = j._calibration()
+        _log.info('jet %d: v_ex = %.1f m/s, M₂ = %.2f, residuals %s', i,
+                c.v_ex, c.m2, ', '.join('{:+.2%}'.format(e) for e in c.residuals))
+
+@contextlib.contextmanager
+def _rendering(e):
+    before = templates.table_stats()
+    with profiling.stage('engine ' + e.name):
+        yield
+    hits, misses = (templates.table_stats()[k] - before[k]
+            for k in ('hits', 'misses'))
+    if hits:
+        _log.info('engine %s: %d of %d tables reused', e.name, hits,
+                hits + misses)
+
+def _render(e):
+    with _rendering(e):
+        return e.render_file()
+
+def _render_group(engines):
+    """Render engines and return list of (data, None) or (None, exception)."""
+    res = []
+    for e in engines:
+        try:
+            res.append((_render(e), None))
+        except Exception as ex:
+            res.append((None, ex))
+    return res
+
+def generate_engines(engines, sink, workers=None, cache=None):
+    """Generate engine files and pass them to sink.
+
+    With workers other than 1, the engines are rendered on a pool of that
+    many processes (default is number of CPUs), but no more than there are
+    groups of engines with equal tables; each group is rendered by one
+    process, so it computes the tables once. Each file is passed on as soon
+    as its group is ready. With one process, no pool is started.
+
+    Engines the sink already has are skipped. With cache (a
+    cache.FileCache), engines found in it are taken from it instead of
+    rendering, and the rendered ones are added to it.
+
+    A failure is logged for each engine that failed, and RuntimeError
+    listing them is raised after all other engines have been passed on.
+    """
+    engines = list(engines)
+    failed = []
+    keys = {}
+
+    def fail(e, ex):
+        _log.error('engine %s: %s: %s', e.name, type(ex).__name__, ex,
+                exc_info=ex if _log.isEnabledFor(logging.DEBUG) else None)
+        failed.append(e.name)
+
+    def done(e, data):
+        sink.engine(e.get_file_name(), data, keys[e.name])
+        if cache is not None:
+            cache.put(cache.key(*keys[e.name]), data)
+
+    pending = []
+    for e in engines:
+        try:
+            keys[e.name] = e.get_file_key()
+            if not sink.has(e.get_file_name(), keys[e.name]):
+                pending.append(e)
+        except Exception as ex:
+            fail(e, ex)
+    if len(pending) + len(failed) < len(engines):
+        _log.info('%d of %d engines unchanged',
+                len(engines) - len(pending) - len(failed), len(engines))
+    engines = pending
+
+    if cache is not None:
+        pending = []
+        with profiling.stage('cache'):
+            for e in engines:
+                try:
+                    data = cache.get(cache.key(*keys[e.name]))
+                    if data is None:
+                        pending.append(e)
+                    else:
+                        sink.engine(e.get_file_name(), data, keys[e.name])
+                except Exception as ex:
+                    fail(e, ex)
+        _log.info('%d of %d engines found in cache',
+                len(engines) - len(pending), len(engines))
+        engines = pending
+
+    # Engines sharing their tables are rendered by the same process, so
+    # that they reuse them (see templates.keyed).
+    groups = collections.OrderedDict()
+    for e in engines:
+        groups.setdefault(e._thrust_params(), []).append(e)
+    workers = min(workers or os.cpu_count() or 1, len(groups))
+
+    if workers <= 1 and cache is None and sink.streams:
+        for e in engines:
+            try:
+                # The tables are computed as the sink writes the file.
+                with _rendering(e):
+                    sink.engine(e.get_file_name(), e.stream_file(),
+                            keys[e.name])
+            except Exception as ex:
+                fail(e, ex)
+    elif workers <= 1:
+        for e in engines:
+            try:
+                done(e, _render(e))
+            except Exception as ex:
+                fail(e, ex)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                initializer=templates.preload,
+                initargs=(templates.xml_loader.cache, engines[0]._template)) as pool:
+            futures = {profiling.submit(pool, _render_group, g): g
+                    for g in groups.values()}
+            for f in concurrent.futures.as_completed(futures):
+                try:
+                    results = profiling.result(f)
+                except Exception as ex:
+                    results = [(None, ex)] * len(futures[f])
+                for e, (data, error) in zip(futures[f], results):
+                    if error is not None:
+                        fail(e, error)
+                        continue
+                    try:
+                        done(e, data)
+                    except Exception as ex:
+                        fail(e, ex)
+
+    if failed:
+        raise RuntimeError('generating engines {} failed'.format(
+            ', '.join(failed)))
+
+def parse(source, definitions=None, cache=None, filename=None):
+    """Parse model template source and calibrate its jets.
+
+    The arguments are as for convert. Returns model.Airplane.
+    """
+    # Imported here, so that just preprocessing does not load the units.
+    from .model import Airplane
+
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    with profiling.stage('preprocess'):
+        dom = templates.load_dom(source, definitions or {},
+                filename or getattr(source, 'name', '<string>'))
+    with profiling.stage('parse'):
+        aircraft = Airplane.parse(dom)
+    with profiling.stage('calibrate'):
+        calibrate(aircraft.jets, cache)
+    return aircraft
+
+def convert(source, definitions=None, sink=None, workers=1, cache=None,
+        filename=None, verify=None, library=None):
+    """Convert model template source and generate its engines.
+
+    :source: is the template as str, bytes or binary file object.
+    :definitions: is dict of values made available in the template.
+    :sink: is Sink to pass the outputs to; default is to return them.
+    :workers: is number of processes to render engines on (see
+    generate_engines).
+    :cache: is cache.FileCache for the engines and calibrations, or None.
+    The templates are cached in templates.xml_loader.cache.
+    :filename: is name of the template in error messages; default is name
+    of the file object.
+    :verify: is tolerance to check the thrust tables of the generated
+    engines with (see VerifyingSink), or None not to check them.
+    :library: is library.Library to name the jets after, so that the
+    rendered aircraft refers to its engines; the sink should then be
+    library.LibrarySink.
+
+    Returns Result.
+    """
+    memory = MemorySink() if sink is None else None
+    sink = sink or memory
+    aircraft = parse(source, definitions, cache, filename)
+    if library is not None:
+        with profiling.stage('library'):
+            library.assign(aircraft.jets)
+
+    if sink.wants_aircraft:
+        with profiling.stage('render'):
+            text = aircraft.render(pretty=True)
+        sink.aircraft(text)
+
+    engines = list(aircraft.engines_to_generte())
+    if verify is not None:
+        sink = VerifyingSink(sink, engines, verify)
+    with profiling.stage('engines'):
+        generate_engines(engines, sink, workers, cache)
+
+    if memory is None:
+        return Result(aircraft, None, {})
+    return Result(aircraft, memory.aircraft_text, memory.engines)
@@ -2,16 +2,23 @@
 
 Calculation of pressure and density in ISO Standard atmosphere copied and
 translated from YASim.
+
+All functions accept a quantity wrapping a NumPy array as well as a scalar
+one and return a single quantity of the same shape, so whole grids of
+altitudes and Mach numbers can be evaluated in one call. The *SI variants
+do the same on plain numbers in SI units.
 """
 
-import bisect
 import collections
+import numpy
 
+from .profiling import counted
 from .units import U
 
 _Datum = collections.namedtuple('_Datum', ['a', 'T', 'p', 'rho'])
 
 _kg_m_3 = U.kg * U.m ** -3
+_units = _Datum(U.m, U.K, U.Pa, _kg_m_3)
 _data = [
         _Datum(a * U.m, T * U.K, p * U.Pa, rho * _kg_m_3)
         for a, T, p, rho in (
@@ -54,7 +61,22 @@ _data = [
             )
         ]
 
-_alts = [d.a for d in _data]
+# The same table as plain magnitudes in base units, one column per _Datum
+# field.
+_table = numpy.array([[float(d[j] / _units[j]) for j in range(len(d))]
+    for d in _data]).T
+_alts = _table[0]
+
+# The table resampled every _step metres, so the segment an altitude falls
+# in is found by division instead of search. The breakpoints are whole
+# metres, so interpolating in it gives the same values. It is built once
+# on import and never written, so forked workers share its pages.
+_step = 1.0
+_grid = numpy.array([numpy.interp(
+    numpy.arange(_alts[0], _alts[-1] + _step / 2, _step), _alts, c)
+    for c in _table])
+_grid.setflags(write=False)
+_last = _grid.shape[1] - 2
 
 # Specific gas constant for air
 Rs_air = 297.1 * U.J / U.kg / U.K
@@ -64,34 +86,88 @@ Rs_air = 297.1 * U.J / U.kg / U.K
 # Also known as gamma.
 kappa = 1.4
 
-def _get(a, j):
-    i = bisect.bisect(_alts, a)
-    d0 = _data[i]
-    d1 = _data[i + 1]
-    frac = float((a - d0.a)/(d1.a - d0.a))
-    return d0[j] + frac * (d1[j] - d0[j])
+def _interp(a, j):
+    """Interpolate column j of the table at altitudes a (metres).
+
+    Returns a scalar for scalar a, otherwise an array.
+
+    The table spans -900 m to 30785 m. Below and above it, the first or
+    last segment is extrapolated linearly, like YASim does, but clamped at
+    zero: pressure and density reach it some 6 km above the top and stay
+    there instead of going negative.
+    """
+    if isinstance(a, (float, int)):
+        x = (a - _alts[0]) / _step
+        try:
+            i = min(max(int(x), 0), _last)
+        except (ValueError, OverflowError):
+            pass  # NaN or infinity; let NumPy handle it
+        else:
+            v0 = _grid[j, i]
+            return max(v0 + (x - i) * (_grid[j, i + 1] - v0), 0.)
+    x = (numpy.asarray(a, dtype=float) - _alts[0]) / _step
+    # NaN gives NaN through x below whatever the index
+    i = numpy.clip(numpy.nan_to_num(numpy.floor(x)), 0, _last).astype(int)
+    v0 = _grid[j][i]
+    return numpy.maximum(v0 + (x - i) * (_grid[j][i + 1] - v0), 0.)[()]
+
+def _magnitude(q, unit):
+    """Magnitude of q in unit; plain numbers and arrays are passed through."""
+    if isinstance(q, U.Quantity):
+        return q.m_as(unit)
+    return q
+
+# The *SI functions take and return plain numbers or arrays in SI units
+# (m, K, Pa, kg/m³, m/s), so the table computations don't pay for pint on
+# every operation; the others wrap them for quantities.
+
+Rs_air_SI = Rs_air.m_as(U.J / U.kg / U.K)
+_m_s = U.m / U.s
+
+@counted
+def getStdTemperatureSI(a):
+    return _interp(a, 1)
+
+@counted
+def getStdPressureSI(a):
+    return _interp(a, 2)
+
+@counted
+def getStdDensitySI(a):
+    return _interp(a, 3)
+
+@counted
+def calcDensitySI(p, T):
+    return p / (Rs_air_SI * T)
+
+@counted
+def speedOfSoundSI(T):
+    # a = √(γ Rs T)
+    return (kappa * Rs_air_SI * T) ** 0.5
+
+# Works equally for scalar and array altitudes; a scalar comes back as
+# a scalar quantity, an array as one quantity wrapping an array.
 
 def getStdTemperature(a):
-    return _get(a, 1)
+    return getStdTemperatureSI(a.m_as(_units.a)) * _units.T
 
 def getStdPressure(a):
-    return _get(a, 2)
+    return getStdPressureSI(a.m_as(_units.a)) * _units.p
 
 def getStdDensity(a):
-    return _get(a, 3)
+    return getStdDensitySI(a.m_as(_units.a)) * _units.rho
 
 def calcDensity(p, T):
-    return p / (Rs_air * T.to_base_units())
+    return calcDensitySI(p.m_as(_units.p), T.m_as(_units.T)) * _units.rho
 
 def speedOfSound(T):
-    # a = √(γ Rs T)
     # √(J/kg/K * K) = √(kg m²/s²/kg) = m/s ✓
-    return (kappa * Rs_air * T.to(U.K)) ** 0.5
+    return speedOfSoundSI(T.m_as(_units.T)) * _m_s
 
 def machFromSpd(v, T):
     # Ma = v / a
-    return float(v / speedOfSound(T))
+    return v.m_as(_m_s) / speedOfSoundSI(T.m_as(_units.T))
 
 def spdFromMach(Ma, T):
     # v = Ma * a
-    return float(Ma) * speedOfSound(T)
+    return _magnitude(Ma, U.dimensionless) * speedOfSound(T)
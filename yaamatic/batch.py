@@ -0,0 +1,226 @@
+"""Conversion of many models in one invocation.
+
+The models are converted by a pool of worker processes, so the interpreter,
+unit registry and template loader start-up is paid once per worker rather
+than once per model, and the conversions run on all cores. Engines of
+a single model can similarly be generated in parallel.
+"""
+
+from os.path import dirname, join
+import collections
+import concurrent.futures
+import logging
+import os
+import shlex
+import sys
+import time
+
+from . import api
+from . import profiling
+from . import templates
+from .templates import load_stream
+
+_log = logging.getLogger(__name__)
+
+class Job(collections.namedtuple('Job',
+        ['model', 'definitions', 'output', 'dir', 'engines_dir'])):
+    """Conversion of one model template.
+
+    :model: is path to the model template, - for standard input.
+    :definitions: is dict of values made available in the template.
+    :output: is path to write the parsed aircraft to, or None.
+    :dir: is the directory to write output to, or None for default.
+    :engines_dir: is the directory to write engines to, or None for default.
+    """
+    __slots__ = ()
+
+    def get_dir(self):
+        if self.dir is not None:
+            return self.dir
+        elif self.output is not None:
+            return dirname(self.output)
+        else:
+            return ''
+
+    def get_engines_dir(self):
+        if self.engines_dir is not None:
+            return self.engines_dir
+        return join(self.get_dir(), 'Engines')
+
+def _open(path):
+    if path == '-':
+        return sys.stdin.buffer
+    return open(path, 'rb')
+
+def preprocess(job):
+    """Return the preprocessed model of job as XML string."""
+    with profiling.stage('preprocess'), _open(job.model) as f:
+        return load_stream(f, job.definitions)
+
+def convert(job, out=None, workers=1, cache=None, known=None, verify=None,
+        library=None):
+    """Convert one model and generate its engines.
+
+    The parsed aircraft is written to job.output, or to file object out if
+    job.output is not set, and returned. The engines are generated on up
+    to workers processes, using cache if given and skipping those known
+    (see api.DirectorySink), and their tables checked if verify is given
+    (see api.convert). With library (a library.Library), the engines are
+    generated into it instead of job.get_engines_dir().
+    """
+    # Note: If job.output is not defined, we can't define it yet, because it
+    # may be specified _inside_ the model!
+    if library is None:
+        sink = api.DirectorySink(job.get_engines_dir(), job.output, out, known)
+    else:
+        from .library import LibrarySink
+
+        sink = LibrarySink(library, job.output, out)
+    with _open(job.model) as f:
+        aircraft = api.convert(f, job.definitions, sink, workers, cache,
+                verify=verify, library=library).model
+    for i, f in aircraft.engine_map():
+        _log.info('%s: jet %d: %s', job.model, i, f)
+
+    return aircraft
+
+def _stamps(paths):
+    stamps = {}
+    for p in paths:
+        try:
+            stamps[p] = os.stat(p).st_mtime_ns
+        except FileNotFoundError:
+            stamps[p] = None
+    return stamps
+
+def watch(job, out=None, cache=None, verify=None, library=None,
+        interval=0.05):
+    """Convert job and again whenever the files it was made from change.
+
+    The files are the model, the templates it includes and the engine
+    template, polled every interval seconds. Templates stay loaded, and
+    only engines whose file key changed are generated again, serially,
+    which is faster than starting processes for the few that do. Errors
+    are logged and the files watched for a fix. Runs until interrupted.
+    """
+    if job.model == '-':
+        raise ValueError("can't watch standard input")
+    templates.xml_loader.auto_reload = True
+    known = {}
+    paths = [job.model]
+    while True:
+        stamps = _stamps(paths)
+        try:
+            convert(job, out, 1, cache, known, verify, library)
+            _log.info('%s converted', job.model)
+        except Exception as e:
+            _log.error('%s: %s: %s', job.model, type(e).__name__, e,
+                    exc_info=e if _log.isEnabledFor(logging.DEBUG) else None)
+        paths = [job.model] + templates.loaded_files()
+        # Changes made while converting count too
+        stamps = dict(_stamps(paths), **stamps)
+        while _stamps(paths) == stamps:
+            time.sleep(interval)
+
+def read_manifest(f, parser, definitions):
+    """Read jobs from manifest file f.
+
+    Each line holds a model path optionally followed by per-model options
+    in shell syntax; # starts a comment. The options are parsed by parser,
+    whose error method should raise ValueError. Relative paths are relative
+    to the manifest's directory. The definitions apply to every model and
+    may be overridden on its line.
+    """
+    base = dirname(f.name)
+    for n, line in enumerate(f, 1):
+        try:
+            args = shlex.split(line, comments=True)
+            if not args:
+                continue
+            a = parser.parse_args(args)
+        except ValueError as e:
+            raise ValueError('{}:{}: {}'.format(f.name, n, e)) from e
+        yield Job(join(base, a.model), dict(definitions, **dict(a.define)),
+                *(p if p is None else join(base, p)
+                    for p in (a.output, a.dir, a.engines_dir)))
+
+def _init_worker(level, cache):
+    from .model import JetEngine
+
+    logging.basicConfig(format='%(name)s: %(message)s', level=level)
+    templates.preload(cache, JetEngine._template)
+
+def _error(e):
+    # Exceptions from dexml and genshi don't always pickle, so only
+    # the message is passed back.
+    return '{}: {}'.format(type(e).__name__, e)
+
+def _run(job, cache, verify, library):
+    try:
+        convert(job, cache=cache, verify=verify, library=library)
+        return None
+    except Exception as e:
+        return _error(e)
+
+def _identify(job, cache):
+    """Return ((name, identity) of the jets for Library.reserve, error)."""
+    from .library import identity
+
+    try:
+        with _open(job.model) as f:
+            aircraft = api.parse(f, job.definitions, cache)
+        return [(j.name, identity(j)) for j in aircraft.jets], None
+    except Exception as e:
+        return None, _error(e)
+
+def run(jobs, workers=None, cache=None, verify=None, library=None):
+    """Convert jobs on a pool of worker processes.
+
+    :workers: is the number of processes, default is number of CPUs.
+    :cache: is cache.FileCache for the engines and templates, or None.
+    :verify: is tolerance to check the thrust tables with, or None.
+    :library: is library.Library to generate all the engines into, or None.
+
+    Returns list of (job, error) in order of jobs; error is None on success.
+    """
+    jobs = list(jobs)
+    errors = [None] * len(jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+            initializer=_init_worker,
+            initargs=(logging.getLogger().getEffectiveLevel(), cache)) as pool:
+        if library is not None:
+            # The jets are named in order of the jobs before any is
+            # converted, so the names don't depend on which worker gets to
+            # the library first.
+            futures = [profiling.submit(pool, _identify, j, cache)
+                    for j in jobs]
+            for i, f in enumerate(futures):
+                jets, errors[i] = profiling.result(f)
+                if jets is not None:
+                    try:
+                        library.reserve(jets)
+                    except ValueError as e:
+                        errors[i] = _error(e)
+                if errors[i] is not None:
+                    _log.info('FAILED %s', jobs[i].model)
+        futures = {profiling.submit(pool, _run, j, cache, verify, library): i
+                for i, j in enumerate(jobs) if errors[i] is None}
+        for f in concurrent.futures.as_completed(futures):
+            i = futures[f]
+            errors[i] = profiling.result(f)
+            _log.info('%s %s', 'done' if errors[i] is None else 'FAILED',
+                    jobs[i].model)
+        return list(zip(jobs, errors))
+
+def report(results, out):
+    """Write summary of results of run to out; returns number of failures."""
+    failed = 0
+    for job, error in results:
+        if error is None:
+            print('ok      {}'.format(job.model), file=out)
+        else:
+            failed += 1
+            print('FAILED  {}: {}'.format(job.model, error), file=out)
+    print('{} converted, {} failed'.format(len(results) - failed, failed),
+            file=out)
+    return failed
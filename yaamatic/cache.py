@@ -0,0 +1,103 @@
+"""Content-addressed on-disk cache of generated files.
+
+Entries are looked up by a hash of everything the content depends on, so
+they never need invalidating; the least recently used ones are simply
+removed when the cache grows over its size limit.
+"""
+
+import glob
+import hashlib
+import logging
+import os
+import os.path
+import tempfile
+
+_log = logging.getLogger(__name__)
+
+def default_dir():
+    return os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+            'yaamatic')
+
+# Where pint keeps its parsed unit definitions, or None not to keep them.
+# Only has effect if set before yaamatic.units is first imported. None by
+# default, so that using yaamatic as library does not write anywhere; the
+# command line sets it from --cache-dir.
+units_dir = None
+
+_code_digest = None
+
+def code_digest():
+    """Digest of yaamatic version and source, part of every key."""
+    global _code_digest
+    if _code_digest is None:
+        from . import __version__
+        h = hashlib.sha256(__version__.encode())
+        for f in sorted(glob.glob(os.path.join(os.path.dirname(__file__), '*.py'))):
+            with open(f, 'rb') as s:
+                h.update(s.read())
+        _code_digest = h.hexdigest()
+    return _code_digest
+
+class FileCache:
+    """Cache of byte strings in directory path, limited to max_size bytes."""
+
+    def __init__(self, path, max_size=100 * 2**20):
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, *parts):
+        """Key for content determined by parts, which must have stable repr."""
+        h = hashlib.sha256(code_digest().encode())
+        h.update(repr(parts).encode())
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """Return content stored under key or None."""
+        f = self._file(key)
+        try:
+            with open(f, 'rb') as s:
+                data = s.read()
+            # The modification time serves as time of last use.
+            os.utime(f)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data):
+        f = self._file(key)
+        os.makedirs(os.path.dirname(f), exist_ok=True)
+        # Written under hidden temporary name and renamed, so concurrent
+        # readers never see partial entry and trim doesn't see it at all.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(f), prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as s:
+                s.write(data)
+            os.replace(tmp, f)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def trim(self):
+        """Remove least recently used entries over the size limit."""
+        entries = []
+        for f in glob.glob(os.path.join(self.path, '??', '*')):
+            try:
+                st = os.stat(f)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, f))
+        size = sum(e[1] for e in entries)
+        for mtime, fsize, f in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(f)
+            except FileNotFoundError:
+                pass
+            size -= fsize
+        _log.debug('cache %s: %d bytes in %d entries', self.path, size,
+                len(entries))
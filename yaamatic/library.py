@@ -0,0 +1,127 @@
+"""Engine library shared by many aircraft.
+
+Jets are identified by everything their engine file depends on except the
+name (see JetEngine.get_signature), so equal jets of any aircraft get the
+same engine file in the library directory. The names given to them and
+the keys of the files generated are kept in index.json there, so later
+runs reuse both. The index is locked while it is updated, so models
+converted in parallel share the library too.
+"""
+
+from os.path import join
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+
+from . import api
+from . import cache
+
+def _digest(*parts):
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+def identity(jet):
+    """What the engine file of JetEngine jet depends on, except the name."""
+    return _digest(jet._template, jet.get_signature())
+
+class Library:
+    """Library of engine files in directory path.
+
+    :prefix: is the start of the names given to unnamed jets.
+    """
+
+    def __init__(self, path, prefix='turbine'):
+        self.path = path
+        self.prefix = prefix
+        self._index = join(path, 'index.json')
+
+    def _load(self):
+        try:
+            with open(self._index, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'names': {}, 'files': {}}
+
+    @contextlib.contextmanager
+    def _update(self):
+        """Lock the index and yield it to be changed and saved."""
+        os.makedirs(self.path, exist_ok=True)
+        with open(join(self.path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self._load()
+            yield index
+            tmp = '{}.{}'.format(self._index, os.getpid())
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+            os.replace(tmp, self._index)
+
+    def assign(self, jets):
+        """Name jets after the library engines they are equal to.
+
+        An unnamed jet takes the name of an equal engine, or a new one
+        the library does not have yet. A named jet adds its name; it is
+        an error if the library has an engine of that name that differs.
+        Must be called before engines_to_generte of their airplane.
+        """
+        names = self.reserve([(j.name, identity(j)) for j in jets])
+        for j, name in zip(jets, names):
+            j.name = name
+
+    def reserve(self, jets):
+        """Like assign, but for jets given as (name, identity) pairs.
+
+        Returns list of their names. When models are converted in
+        parallel, reserving their jets in order first keeps the names
+        from depending on which model gets to the library first.
+        """
+        res = []
+        with self._update() as index:
+            names = index['names']
+            by_identity = {v: k for k, v in names.items()}
+            for name, ident in jets:
+                if name is not None:
+                    if names.setdefault(name, ident) != ident:
+                        raise ValueError("engine '{}' in library '{}' has "
+                                "different parameters".format(name,
+                                    self.path))
+                    by_identity.setdefault(ident, name)
+                else:
+                    name = by_identity.get(ident)
+                    if name is None:
+                        n = 1
+                        while self.prefix + str(n) in names:
+                            n = n + 1
+                        name = self.prefix + str(n)
+                        names[name] = ident
+                        by_identity[ident] = name
+                res.append(name)
+        return res
+
+    def _file_digest(self, key):
+        # Unlike the names, the files depend on the code generating them.
+        return _digest(cache.code_digest(), key)
+
+    def has(self, name, key):
+        """Whether engine file name generated from key is in the library."""
+        return (self._load()['files'].get(name) == self._file_digest(key)
+                and os.path.exists(join(self.path, name)))
+
+    def add(self, name, key):
+        """Record that engine file name was generated from key."""
+        with self._update() as index:
+            index['files'][name] = self._file_digest(key)
+
+class LibrarySink(api.DirectorySink):
+    """DirectorySink writing the engines into library, skipping those it has."""
+
+    def __init__(self, library, output=None, out=None):
+        super().__init__(library.path, output, out)
+        self.library = library
+
+    def engine(self, name, data, key):
+        super().engine(name, data, key)
+        self.library.add(name, key)
+
+    def has(self, name, key):
+        return self.library.has(name, key)
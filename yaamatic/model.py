@@ -1,15 +1,76 @@
 ﻿from dexml import fields
+import collections
 import dexml
-import os.path
+import functools
+import logging
+import numpy
 
 from . import atmosphere
 from . import templates
+from .profiling import counted
 from .units import U, Quantity
 
+_log = logging.getLogger(__name__)
+
+def derived(method):
+    """Cache value of a model method until a field of the model changes.
+
+    Setting a field and changing a list field in place both count.
+
+    Changing a field also drops the values cached by the models containing
+    the changed one, since they may have been derived from it.
+    """
+    @functools.wraps(method)
+    def get(self):
+        cache = self.__dict__.setdefault('_derived', {})
+        try:
+            return cache[method.__name__]
+        except KeyError:
+            value = cache[method.__name__] = method(self)
+            return value
+    return get
+
+class _FieldList(list):
+    """Value of list field that drops derived values of its model when
+    changed in place, like setting a field does."""
+
+    def __init__(self, model, items):
+        super().__init__(items)
+        self._model = model
+
+def _changing(name):
+    method = getattr(list, name)
+    @functools.wraps(method)
+    def change(self, *args):
+        res = method(self, *args)
+        # Unpickling fills the list before it has the model
+        model = self.__dict__.get('_model')
+        if model is not None:
+            model._adopt(self)
+            model._invalidate()
+        return res
+    return change
+
+for _name in ('__setitem__', '__delitem__', '__iadd__', '__imul__', 'append',
+        'extend', 'insert', 'pop', 'remove', 'clear', 'sort', 'reverse'):
+    setattr(_FieldList, _name, _changing(_name))
+
 class Model(dexml.Model):
+    def __init__(self, **kwds):
+        super().__init__(**kwds)
+        # Created here rather than on first access, so that they are
+        # _FieldList. With tagname, dexml needs them None for parsing.
+        for f in self._fields:
+            if isinstance(f, fields.List) and not f.tagname:
+                setattr(self, f.field_name, getattr(self, f.field_name))
+
     @classmethod
     def parse(cls, xml):
         self = super().parse(xml)
+        # dexml sets the fields through the descriptors directly, so the
+        # nested models have to be adopted here.
+        for f in self._fields:
+            self._adopt(getattr(self, f.field_name))
         self.finalize()
         # FIXME FIXME: Exception handling to add at least some context
         return self
@@ -17,6 +78,31 @@ class Model(dexml.Model):
     def finalize(self):
         pass
 
+    # Fields no derived value depends on, so setting them keeps the cached
+    # ones; in particular naming engines keeps calibrations set on them.
+    _placement_fields = ()
+
+    def __setattr__(self, name, value):
+        if isinstance(value, list) and not name.startswith('_'):
+            value = _FieldList(self, value)
+        super().__setattr__(name, value)
+        if not name.startswith('_'):
+            self._adopt(value)
+            if name not in self._placement_fields:
+                self._invalidate()
+
+    def _adopt(self, value):
+        for v in value if isinstance(value, list) else (value,):
+            if isinstance(v, Model):
+                v._parent = self
+
+    def _invalidate(self):
+        """Drop cached derived values of this model and its parents."""
+        self.__dict__.pop('_derived', None)
+        parent = self.__dict__.get('_parent')
+        if parent is not None:
+            parent._invalidate()
+
 # FIXME FIXME FIXME: Move the rest out and split it to separate packages
 # (aircraft, engine etc.)
 class ActionPoint(Model):
@@ -118,9 +204,83 @@ def _pressure_recovery(M0, M2):
     # less than 1.
     return (_k_1_2 * (M0**2 - M2**2) + 1) ** _k_k_1
 
+def _si(q):
+    """Magnitude of quantity q in SI base units."""
+    return q.to_base_units().magnitude
+
+def _canonical(value):
+    """Hashable representation of field value independent of unit."""
+    if isinstance(value, U.Quantity):
+        return float(_si(value))
+    return value
+
+_ft = U.Quantity(1, U.ft).m_as(U.m)
+_m_s = U.m / U.s
+
 def _pressure_recovery_ratio(M0, M2):
     return _pressure_recovery(M0, M2) / _pressure_recovery(0, M2)
 
+# What the thrust functions need of the engine, lowered to plain numbers in
+# SI units.
+_ThrustParams = collections.namedtuple('_ThrustParams',
+        ['rho_ref', 'v_ex', 'm2_dry'])
+
+# XXX: 0.5, a Pischweitz's constant from http://aviation.stackexchange.com/a/19466/524
+_M2_dry = 0.5
+
+# Exhaust velocity in m/s and Mach number at compressor face fitted to thrust
+# points, and the residuals as fractions of the thrust at the points.
+Calibration = collections.namedtuple('Calibration', ['v_ex', 'm2', 'residuals'])
+
+# Candidate Mach numbers at compressor face when fitting it
+_m2_grid = numpy.arange(20, 81) / 100
+
+def calibrate(data):
+    """Fit exhaust velocity, and M₂ where asked, of many engines at once.
+
+    :data: is list of JetEngine.get_calibration_data() of the engines.
+
+    Returns list of Calibration. Its v_ex is NaN for engines whose points
+    don't give an exhaust velocity above their airspeed for any M₂ tried,
+    e.g. because they are all static.
+
+    For given M₂ the thrust ratio, r = prr ⋅ ρ/ρ_ref ⋅ (1 - v₀/v_ex), is
+    linear in 1/v_ex, so it is solved by least squares for all engines and
+    all candidate M₂ together, and the candidate with the least sum of
+    squared residuals is taken for engines that fit it.
+    """
+    g = numpy.concatenate([numpy.full(len(d[2]), i) for i, d in enumerate(data)])
+    M0, rho, v0, r = numpy.array([p for d in data for p in d[2]]).T
+    rho_ref = numpy.array([d[0] for d in data])
+    fit_m2 = numpy.array([d[1] for d in data], dtype=bool)
+
+    # r = a - x/v_ex for each point (row) and candidate M₂ (column)
+    a = (_pressure_recovery_ratio(M0[:, None], _m2_grid[None, :])
+            * (rho / rho_ref[g])[:, None])
+    x = a * v0[:, None]
+    y = a - r[:, None]
+    def per_engine(v):
+        s = numpy.zeros((len(data), len(_m2_grid)))
+        numpy.add.at(s, g, v)
+        return s
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        w = per_engine(x * y) / per_engine(x * x)
+        v_ex = 1 / w
+    v_max = numpy.zeros(len(data))
+    numpy.maximum.at(v_max, g, v0)
+    # Where w is NaN or not positive enough, the points don't determine it
+    valid = v_ex > v_max[:, None]
+    v_ex[~valid] = numpy.nan
+    e = y - x * w[g]
+    sse = per_engine(e * e)
+    sse[~(fit_m2[:, None] & valid)] = numpy.inf
+    sse[~fit_m2, numpy.flatnonzero(_m2_grid == _M2_dry)] = 0
+    k = sse.argmin(axis=1)
+
+    return [Calibration(float(v_ex[i, k[i]]), float(_m2_grid[k[i]]),
+                tuple((e[g == i, k[i]] / r[g == i]).tolist()))
+            for i in range(len(data))]
+
 class JetEngine(Model):
     class meta:
         tagname = 'jet'
@@ -150,6 +310,10 @@ class JetEngine(Model):
     bypassratio = fields.Float(default=0.0)
     flat_temp = Quantity(attrname='flat-to-temp', unit='degC', required=False)
     flat_alt = Quantity(attrname='flat-to-alt', unit='ft', required=False)
+    # Largest error of the thrust tables interpolated in the generated
+    # engine, as fraction of static thrust. When given, the breakpoints are
+    # chosen to meet it instead of fixed.
+    table_tol = fields.Float(attrname='table-tolerance', required=False)
 
     # Alternate properties:
     # NOTE: e.g. GNex list mass flow rate and it should be possible to
@@ -165,50 +329,127 @@ class JetEngine(Model):
         speed = Quantity(unit='knot', required=False)
         throttle = fields.Float(default=1.0)
 
+        @derived
         def get_mach(self):
             if self.mach is None:
-                self.mach = atmosphere.machFromSpd(self.speed,
+                return atmosphere.machFromSpd(self.speed,
                         atmosphere.getStdTemperature(self.alt))
             return self.mach
 
+        @derived
         def getTas(self):
             if self.speed is None:
-                self.speed = atmosphere.spdFromMach(self.mach,
+                return atmosphere.spdFromMach(self.mach,
                         atmosphere.getStdTemperature(self.alt))
             return self.speed
 
+    class ThrustPoint(Cruise):
+        """Further point of known thrust, e.g. from climb performance."""
+        class meta:
+            tagname = 'thrust-point'
+
     cruise = fields.Model(Cruise, required=False)
+    thrust_points = fields.List(ThrustPoint, required=False)
+    # Also fit the Mach number at compressor face of the dry thrust to the
+    # thrust points; needs at least two of them.
+    fit_m2 = fields.Boolean(attrname='fit-m2', default=False)
 
     # Processing functionality:
-    def __eq__(self, other):
-        if self.name == other.name:
-            return True
-        else:
-            return self.thrust == other.thrust and all(
-                    # FIXME: check that the attribute is not specified in
-                    # other, even if it gets value from default
-                    (getattr(other, a) is None or getattr(self, a) == getattr(other, a)
-                        for a in ('n1_idle', 'n1_max', 'n2_idle', 'n2_max',
-                            'tsfc', 'egt', 'epr', 'v_ex', 't_spool',
-                            'bypassratio', 'flat_temp', 'flat_alt')))
 
+    # Fields that only place the engine in the airplane, and fields that only
+    # serve to derive the effective exhaust velocity.
+    _placement_fields = ('name', 'rotate', 'actionpt')
+    _v_ex_fields = ('v_ex', 'cruise', 'thrust_points', 'fit_m2')
+
+    def get_signature(self):
+        """Hashable key of parameters that affect the generated engine file.
+
+        Engines with equal signature generate the same file, except for the
+        name.
+        """
+        return tuple((f.field_name, _canonical(getattr(self, f.field_name)))
+                for f in self._fields
+                if f.field_name not in self._placement_fields + self._v_ex_fields
+                ) + (('v_ex', _canonical(self.get_v_ex())),
+                        ('m2_dry', self._thrust_params().m2_dry))
+
+    @derived
     def _rho_ref(self):
-        """Density for which the nominal thrust applies."""
+        """Density for which the nominal thrust applies, in kg/m³."""
         if self.flat_temp is not None:
-            return atmosphere.calcDensity(
-                    atmosphere.getStdPressure(0 * U.ft), self.flat_temp)
+            return atmosphere.calcDensitySI(
+                    atmosphere.getStdPressureSI(0.), self.flat_temp.m_as(U.K))
         elif self.flat_alt is not None:
-            return atmosphere.getStdDensity(self.flat_alt)
+            return atmosphere.getStdDensitySI(_si(self.flat_alt))
         else:
-            return atmosphere.getStdDensity(0 * U.ft)
+            return atmosphere.getStdDensitySI(0.)
+
+    @derived
+    def _thrust_params(self):
+        """The parameters as _ThrustParams.
+
+        The units are converted here once, so the thrust functions
+        evaluated over whole tables run on plain floats and arrays.
+        """
+        return _ThrustParams(self._rho_ref(), _si(self.get_v_ex()),
+                self._calibration().m2 if self.needs_calibration() else _M2_dry)
+
+    def needs_calibration(self):
+        """Whether exhaust velocity is fitted to several thrust points."""
+        return self.v_ex is None and bool(self.fit_m2 or self.thrust_points)
 
+    @derived
+    def get_calibration_data(self):
+        """Data for calibrate: (ρ_ref, fit M₂, ((M₀, ρ, v₀, r), …)).
+
+        ρ_ref is the reference density and for each of the thrust points
+        M₀ is the Mach number, ρ the air density, v₀ the true airspeed and
+        r the thrust ratio at full throttle, all in SI units.
+        """
+        points = ([self.cruise] if self.cruise is not None else []) + list(
+                self.thrust_points)
+        if self.fit_m2 and len(points) < 2:
+            raise ValueError('fit-m2 needs at least two thrust points')
+        return (self._rho_ref(), self.fit_m2, tuple(
+                (float(p.get_mach()),
+                    float(atmosphere.getStdDensitySI(_si(p.alt))),
+                    float(_si(p.getTas())),
+                    float(p.thrust / p.throttle / self.thrust))
+                for p in points))
+
+    def _check_calibration(self, c):
+        """Raise ValueError if Calibration c is not usable."""
+        if numpy.isnan(c.v_ex):
+            raise ValueError('thrust points give no exhaust velocity above '
+                    'their airspeed')
+        if self.fit_m2 and c.m2 in (_m2_grid[0], _m2_grid[-1]):
+            _log.warning('M₂ = %.2f fitted to thrust points is at the end of '
+                    'the range tried', c.m2)
+
+    @derived
+    def _calibration(self):
+        c = calibrate([self.get_calibration_data()])[0]
+        self._check_calibration(c)
+        return c
+
+    def set_calibration(self, c):
+        """Use Calibration c, found together with other engines.
+
+        Raises ValueError if it is not usable.
+        """
+        self._check_calibration(c)
+        self.__dict__.setdefault('_derived', {})['_calibration'] = c
+
+    @counted
     def _thrust_ratio(self, M0, alt, M2, v_ex):
         """Ratio of thrust at given parameters to static thrust.
 
         :M0: is free stream Mach number.
-        :alt: is altitude.
+        :alt: is altitude in m.
         :M2: is the Mach number at compressor face.
-        :v_ex: is the (effective) exhaust velocity.
+        :v_ex: is the (effective) exhaust velocity in m/s.
+
+        All are plain numbers or arrays.
 
         See http://aviation.stackexchange.com/a/19466/524
         """
@@ -216,64 +457,95 @@ class JetEngine(Model):
         prr = _pressure_recovery_ratio(M0, M2)
 
         # Density for which the nominal thrust applies if the engine is flat-rated:
-        rho_ref = self._rho_ref()
-        rho = atmosphere.getStdDensity(alt)
+        rho_ref = self._thrust_params().rho_ref
+        rho = atmosphere.getStdDensitySI(alt)
 
         # Stream speed
-        v_0 = atmosphere.spdFromMach(M0, atmosphere.getStdTemperature(alt))
+        v_0 = M0 * atmosphere.speedOfSoundSI(atmosphere.getStdTemperatureSI(alt))
 
         r = prr * (rho/rho_ref) * (v_ex - v_0)/v_ex
 
         return r
 
+    @derived
+    @counted
     def get_v_ex(self):
-        if self.v_ex is None:
-            if self.cruise is not None:
-                M0 = self.cruise.get_mach()
-                prr = _pressure_recovery_ratio(M0, 0.5)
-                rho_ref = self._rho_ref()
-                rho = atmosphere.getStdDensity(self.cruise.alt)
-                v0 = self.cruise.getTas()
-                r = float(self.cruise.thrust / self.cruise.throttle / self.thrust)
-                print('prr={}, rho={:~C}, rho_ref={:~C}, M₀={}, v₀={:~C}, r={}'.format(
-                    prr, rho, rho_ref, M0, v0.to_base_units(), r))#DEBUG#
-                print('prr * (rho/rho_ref) = {:~C}'.format(prr * (rho/rho_ref)))
-                # r = prr * (rho/rho_ref) * (v_ex - v0)/v_ex
-                # r = prr * rho/rho_ref * (1 - v0/v_ex)
-                # r * rho_ref / (rho * prr) = 1 - v0/v_ex
-                # v0/v_ex = 1 - r * rho_ref / (rho * prr)
-                # v0/v_ex = (prr * rho - r * rho_ref)/(prr * rho)
-                self.v_ex = v0 * prr * rho / (prr * rho - r * rho_ref)
-            else:
-                print('Using default v_ex')#DEBUG#
-                # FIXME: bypass-ratio-dependent
-                self.v_ex = U('1555 kt')
-            print('v_ex = {:~C}'.format(self.v_ex.to_base_units()))#DEBUG#
-        return self.v_ex
-
+        if self.v_ex is not None:
+            return self.v_ex
+        if self.needs_calibration():
+            v_ex = self._calibration().v_ex * _m_s
+        elif self.cruise is not None:
+            M0 = self.cruise.get_mach()
+            prr = _pressure_recovery_ratio(M0, _M2_dry)
+            rho_ref = self._rho_ref()
+            rho = atmosphere.getStdDensitySI(_si(self.cruise.alt))
+            v0 = _si(self.cruise.getTas())
+            r = float(self.cruise.thrust / self.cruise.throttle / self.thrust)
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug('prr={}, rho={} kg/m³, rho_ref={} kg/m³, M₀={}, v₀={} m/s, r={}'.format(
+                    prr, rho, rho_ref, M0, v0, r))
+                _log.debug('prr * (rho/rho_ref) = {}'.format(prr * (rho/rho_ref)))
+            # r = prr * (rho/rho_ref) * (v_ex - v0)/v_ex
+            # r = prr * rho/rho_ref * (1 - v0/v_ex)
+            # r * rho_ref / (rho * prr) = 1 - v0/v_ex
+            # v0/v_ex = 1 - r * rho_ref / (rho * prr)
+            # v0/v_ex = (prr * rho - r * rho_ref)/(prr * rho)
+            v_ex = v0 * prr * rho / (prr * rho - r * rho_ref) * _m_s
+        else:
+            _log.debug('Using default v_ex')
+            # FIXME: bypass-ratio-dependent
+            v_ex = U('1555 kt')
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('v_ex = {:~C}'.format(v_ex.to_base_units()))
+        return v_ex
+
+    # The table functions work on arrays too, so templates.table2 evaluates
+    # the whole Mach × altitude grid in one call.
+    @templates.vectorized
+    @counted
     def idle_thrust_table(self, M, alt):
         # XXX: Very wild guesses: 0.1 thrust, M₂ = 0.2 because the danger
         # area is about 2.5 times smaller and 1/3 v_ex, because square root
         # of 10 because 1/10 would be too little (the exhaust speed is still
         # well above 45 m/s).
-        return 0.1 * float(self._thrust_ratio(M, alt * U.ft, 0.2,
-            self.get_v_ex() / 3))
+        return 0.1 * self._thrust_ratio(M, alt * _ft, 0.2,
+            self._thrust_params().v_ex / 3)
 
+    @templates.vectorized
+    @counted
     def dry_thrust_table(self, M, alt):
-        # XXX: 0.5, a Pischweitz's constant from http://aviation.stackexchange.com/a/19466/524
-        return float(self._thrust_ratio(M, alt * U.ft, 0.5, self.get_v_ex()))
-
-    def generate(self, outdir):
-        outf = os.path.join(outdir, self.name + '.xml')
-        tmpl = 'turbine_engine.genshi' # XXX: Allow configuration
-        
-        templates.generate(tmpl, outf,
-            self.__dict__,
-            {
-                'idle_thrust_table': self.idle_thrust_table,
-                'dry_thrust_table': self.dry_thrust_table,
+        p = self._thrust_params()
+        return self._thrust_ratio(M, alt * _ft, p.m2_dry, p.v_ex)
+
+    _template = 'turbine_engine.genshi' # XXX: Allow configuration
+
+    def _template_data(self):
+        # The tables only depend on the thrust parameters, so engines that
+        # differ in anything else share them.
+        p = self._thrust_params()
+        return ({f.field_name: getattr(self, f.field_name) for f in self._fields}, {
+                'idle_thrust_table': templates.keyed(self.idle_thrust_table,
+                    ('idle', p)),
+                'dry_thrust_table': templates.keyed(self.dry_thrust_table,
+                    ('dry', p)),
                 })
 
+    def get_file_name(self):
+        return self.name + '.xml'
+
+    def get_file_key(self):
+        """Key of everything in the model the generated file depends on."""
+        return (self._template, templates.digest(self._template), self.name,
+                self.get_signature())
+
+    def render_file(self):
+        """Return content of the engine file as bytes."""
+        return templates.render(self._template, *self._template_data())
+
+    def stream_file(self):
+        """Return content of the engine file as templates.stream."""
+        return templates.stream(self._template, *self._template_data())
+
 class Airplane(Model):
     class meta:
         tagname = 'airplane'
@@ -312,20 +584,42 @@ class Airplane(Model):
 
     # Processing functionality:
     def engines_to_generte(self):
+        """Yield the distinct engines to generate.
+
+        Jets with the same name share one engine file, and so does an
+        unnamed jet with the same signature as an earlier one, whose name
+        it takes. The other unnamed jets are named turbine1, turbine2, …
+        in order, skipping names given in the model.
+        """
         def _engs(list_, name):
+            taken = {e.name for e in list_ if e.name is not None}
+            by_name = {}
+            by_sig = {}
             n = 1
-            for i in range(0, len(list_)):
-                e = list_[i]
-                for f in list_[0:i]:
-                    if e == f:
-                        if e.name is None:
-                            e.name = f.name
-                        break
-                else:
-                    if e.name is None:
-                        e.name = name + str(n)
+            for e in list_:
+                if e.name is None:
+                    sig = e.get_signature()
+                    if sig in by_sig:
+                        e.name = by_sig[sig].name
+                        continue
+                    while name + str(n) in taken:
                         n = n + 1
-                    yield e
+                    e.name = name + str(n)
+                    n = n + 1
+                else:
+                    if e.name in by_name:
+                        continue
+                    sig = e.get_signature()
+                by_name[e.name] = e
+                by_sig.setdefault(sig, e)
+                yield e
 
         yield from _engs(self.jets, 'turbine')
 
+    def engine_map(self):
+        """List (jet number, engine file name) for the jets in the model.
+
+        Jets are numbered from 1 in order of the model; the names are only
+        known after engines_to_generte has been consumed.
+        """
+        return [(i, e.get_file_name()) for i, e in enumerate(self.jets, 1)]
@@ -0,0 +1,141 @@
+"""Profiling of conversion stages.
+
+Stages are timed with the stage context manager and calls of the hot
+functions counted with the counted decorator. Both only check a flag unless
+enable has been called, so they stay in the code permanently.
+
+Stages nest, and their times include the nested ones. Work done in worker
+processes is collected if it is submitted through submit and its result
+retrieved through result.
+"""
+
+import collections
+import contextlib
+import functools
+import time
+
+enabled = False
+
+# name: [calls, wall time, cpu time]
+_stages = collections.OrderedDict()
+_counts = collections.Counter()
+_profiler = None
+_dump = None
+_stats_sources = []
+# Counts of the stats sources in worker processes
+_remote_other = collections.Counter()
+
+def enable(dump=None):
+    """Start collecting; with dump, also run cProfile and save it there."""
+    global enabled, _profiler, _dump
+    enabled = True
+    if dump is not None:
+        import cProfile
+
+        _dump = dump
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+@contextlib.contextmanager
+def stage(name):
+    if not enabled:
+        yield
+        return
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        s = _stages.setdefault(name, [0, 0., 0.])
+        s[0] += 1
+        s[1] += time.perf_counter() - wall
+        s[2] += time.process_time() - cpu
+
+def counted(fn):
+    """Count calls of fn under its qualified name."""
+    name = '{}.{}'.format(fn.__module__.rpartition('.')[2], fn.__qualname__)
+    @functools.wraps(fn)
+    def call(*args, **kwargs):
+        if enabled:
+            _counts[name] += 1
+        return fn(*args, **kwargs)
+    return call
+
+def add_stats(source):
+    """Report also counts returned by source, a callable returning dict.
+
+    They are taken when reporting, and the counts in worker processes are
+    added as for stats.
+    """
+    _stats_sources.append(source)
+
+def _other():
+    # Counter.update rather than +, which drops zero counts
+    res = collections.Counter()
+    for source in _stats_sources:
+        res.update(source())
+    res.update(_remote_other)
+    return res
+
+def stats():
+    return dict(_stages), dict(_counts), dict(_other())
+
+def merge(other):
+    """Add stats collected elsewhere."""
+    stages, counts, other_counts = other
+    for name, (calls, wall, cpu) in stages.items():
+        s = _stages.setdefault(name, [0, 0., 0.])
+        s[0] += calls
+        s[1] += wall
+        s[2] += cpu
+    _counts.update(counts)
+    _remote_other.update(other_counts)
+
+def _remote(fn, *args):
+    global enabled
+    enabled = True
+    _stages.clear()
+    _counts.clear()
+    # The sources count for the life of the worker, which may have run
+    # other tasks before, so only the difference is passed back.
+    before = _other()
+    value = fn(*args)
+    stages, counts, other = stats()
+    return value, (stages, counts,
+            {k: v - before.get(k, 0) for k, v in other.items()})
+
+def submit(pool, fn, *args):
+    """Submit fn(*args) to executor pool, collecting its stats if enabled."""
+    if enabled:
+        return pool.submit(_remote, fn, *args)
+    return pool.submit(fn, *args)
+
+def result(future):
+    """Return result of future from submit and merge its stats.
+
+    Must be called exactly once for each future.
+    """
+    if enabled:
+        value, other = future.result()
+        merge(other)
+        return value
+    return future.result()
+
+def report(out):
+    """Write the collected stats to out and save cProfile data if enabled."""
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_dump)
+    print('{:40} {:>7} {:>10} {:>10}'.format('stage', 'calls', 'wall s',
+        'cpu s'), file=out)
+    for name, (calls, wall, cpu) in _stages.items():
+        print('{:40} {:7} {:10.4f} {:10.4f}'.format(name, calls, wall, cpu),
+                file=out)
+    print('{:40} {:>7}'.format('function', 'calls'), file=out)
+    for name, calls in sorted(_counts.items()):
+        print('{:40} {:7}'.format(name, calls), file=out)
+    other = _other()
+    if other:
+        print('{:40} {:>7}'.format('other', 'count'), file=out)
+        for name, count in sorted(other.items()):
+            print('{:40} {:7}'.format(name, count), file=out)
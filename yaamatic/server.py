@@ -0,0 +1,239 @@
+"""Conversion server.
+
+Keeps a pool of worker processes with the units and templates loaded and
+converts models sent to it as JSON, one request per line, over standard
+input and output or a Unix socket. Each request gets one response line,
+in order of completion, so they should carry an id:
+
+    {"id": 1, "model": "c172/c172.xml", "output": "c172/c172-jsb.xml"}
+    {"id": 2, "template": "<airplane>…</airplane>", "definitions": {"N": 2}}
+
+A request has either model, path to the model template, or template, its
+content. definitions, output, dir and engines_dir are as the command line
+options, paths relative to the directory the server runs in. With
+template and none of output, dir and engines_dir, nothing is written and
+the response has the aircraft and the engine files in it. timeout is the
+limit in seconds for the conversion.
+
+The response has id, status (ok, error or timeout), error message if not
+ok, time taken in seconds and jets, list of [jet number, engine file].
+
+At most --queue requests are accepted at a time; further input is not read
+until one completes, so a client sending faster than the workers convert
+is held back by the pipe or socket filling up.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+from . import cache
+
+_log = logging.getLogger(__name__)
+
+_cache = None
+
+def _init(level, cache):
+    global _cache
+    from . import batch
+
+    batch._init_worker(level, cache)
+    _cache = cache
+
+class _Timeout(BaseException):
+    # Not Exception, so it is not taken for failure of the engine being
+    # generated when it strikes.
+    pass
+
+def _alarm(signum, frame):
+    raise _Timeout()
+
+def _convert(request):
+    """Convert request in worker and return its response without id."""
+    from . import api
+    from . import batch
+
+    if not isinstance(request.get('definitions', {}), dict):
+        raise ValueError('definitions must be object')
+    job = batch.Job(request.get('model', '<request>'),
+            request.get('definitions', {}), request.get('output'),
+            request.get('dir'), request.get('engines_dir'))
+    if 'model' in request:
+        aircraft = batch.convert(job, None, 1, _cache)
+        return {'jets': aircraft.engine_map()}
+    if not isinstance(request.get('template'), str):
+        raise ValueError('request must have model or template')
+    if job.output is None and job.dir is None and job.engines_dir is None:
+        res = api.convert(request['template'], job.definitions, None, 1,
+                _cache)
+        return {'jets': res.model.engine_map(), 'aircraft': res.aircraft,
+                'engines': {n: d.decode('utf-8')
+                    for n, d in res.engines.items()}}
+    sink = api.DirectorySink(job.get_engines_dir(), job.output)
+    res = api.convert(request['template'], job.definitions, sink, 1, _cache)
+    return {'jets': res.model.engine_map()}
+
+def _run(request, timeout):
+    t = time.perf_counter()
+    timeout = request.get('timeout', timeout)
+    try:
+        # The alarm is armed and cancelled within the outer try, so it
+        # cannot strike where _Timeout would not be caught.
+        try:
+            if timeout:
+                signal.signal(signal.SIGALRM, _alarm)
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            res = dict(_convert(request), status='ok')
+        finally:
+            if timeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    except _Timeout:
+        res = {'status': 'timeout',
+                'error': 'not converted in {} s'.format(timeout)}
+    except Exception as e:
+        # Only the message, like batch; the exceptions don't always pickle.
+        res = {'status': 'error', 'error': '{}: {}'.format(type(e).__name__, e)}
+    res['time'] = time.perf_counter() - t
+    return res
+
+class Server:
+    """Pool of workers serving requests from any number of streams.
+
+    :workers: is number of processes, default is number of CPUs.
+    :queue: is number of requests accepted at a time, default twice the
+    number of workers.
+    :timeout: is default limit on conversion time in seconds, or None.
+    :cache: is cache.FileCache for the engines and templates, or None.
+    """
+
+    def __init__(self, workers=None, queue=None, timeout=None, cache=None):
+        self.workers = workers or os.cpu_count()
+        self.timeout = timeout
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init,
+                initargs=(logging.getLogger().getEffectiveLevel(), cache))
+        self.slots = threading.BoundedSemaphore(queue or 2 * self.workers)
+
+    def close(self):
+        self.pool.shutdown()
+
+    def serve(self, rfile, wfile):
+        """Answer requests read from rfile on wfile until end of rfile.
+
+        Both are binary; returns after all responses have been written.
+        """
+        lock = threading.Condition()
+        pending = set()
+
+        def respond(rid, res):
+            res['id'] = rid
+            line = json.dumps(res, ensure_ascii=False).encode('utf-8') + b'\n'
+            with lock:
+                try:
+                    wfile.write(line)
+                    wfile.flush()
+                except OSError as e:
+                    _log.warning('response %s lost: %s', rid, e)
+
+        def done(rid, future):
+            try:
+                try:
+                    res = future.result()
+                except BaseException as e:
+                    # Worker died, or anything else; the slot must be
+                    # released whatever happened.
+                    res = {'status': 'error',
+                            'error': '{}: {}'.format(type(e).__name__, e)}
+                respond(rid, res)
+            finally:
+                self.slots.release()
+                with lock:
+                    pending.discard(future)
+                    lock.notify()
+
+        for line in rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError('request must be object')
+            except ValueError as e:
+                respond(None, {'status': 'error', 'error': str(e)})
+                continue
+            rid = request.get('id')
+            self.slots.acquire()
+            try:
+                f = self.pool.submit(_run, request, self.timeout)
+            except Exception as e:
+                self.slots.release()
+                respond(rid, {'status': 'error',
+                    'error': '{}: {}'.format(type(e).__name__, e)})
+                continue
+            with lock:
+                pending.add(f)
+            f.add_done_callback(lambda f, rid=rid: done(rid, f))
+        with lock:
+            lock.wait_for(lambda: not pending)
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.yaamatic.serve(self.rfile, self.wfile)
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def main(args=None):
+    p = argparse.ArgumentParser(prog='yaamatic serve',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('-s', '--socket', type=str,
+            help="Listen on Unix socket SOCKET instead of standard input. "
+                +"Each connection is served like standard input.")
+    p.add_argument('-j', '--jobs', type=int,
+            help="Number of worker processes, default is number of processors.")
+    p.add_argument('-q', '--queue', type=int,
+            help="Number of requests accepted at a time, default twice the "
+                +"number of workers.")
+    p.add_argument('-t', '--timeout', type=float,
+            help="Default limit on time of one conversion in seconds.")
+    p.add_argument('--cache-dir', type=str, default=cache.default_dir(),
+            help="Directory where generated engines and compiled "
+                +"templates are cached. Default is %(default)s.")
+    p.add_argument('--no-cache', action='store_true',
+            help="Don't use the cache.")
+    p.add_argument('-v', '--verbose', action='count', default=0,
+            help="Report progress on standard error.")
+    a = p.parse_args(args)
+
+    logging.basicConfig(format='%(name)s: %(message)s',
+            level=logging.WARNING - 10 * a.verbose)
+    cache.units_dir = None if a.no_cache else os.path.join(a.cache_dir, 'pint')
+    engine_cache = None if a.no_cache else cache.FileCache(a.cache_dir)
+
+    server = Server(a.jobs, a.queue, a.timeout, engine_cache)
+    try:
+        if a.socket is None:
+            server.serve(sys.stdin.buffer, sys.stdout.buffer)
+        else:
+            with _UnixServer(a.socket, _Handler) as s:
+                s.yaamatic = server
+                _log.info('listening on %s', a.socket)
+                try:
+                    s.serve_forever()
+                finally:
+                    os.unlink(a.socket)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if engine_cache is not None:
+            engine_cache.trim()
+    return 0
@@ -0,0 +1,294 @@
+"""Parameter sweep of a jet engine.
+
+Evaluates the exhaust velocity and the thrust tables of many variants of
+one engine, differing in the swept parameters, and writes them to a single
+CSV or NumPy .npz file. Nothing is rendered, so thousands of variants take
+seconds; they are evaluated on a pool of worker processes.
+
+    yaamatic sweep model.xml -p thrust=20000:40000:5 -p bypassratio=0,4,8 -o out.npz
+"""
+
+from dexml import fields
+from xml.etree import ElementTree
+import argparse
+import concurrent.futures
+import csv
+import logging
+import numpy
+import os
+import sys
+
+from . import _Definition
+from . import batch
+from . import profiling
+from .model import Airplane, JetEngine
+from .units import U, Quantity
+
+_log = logging.getLogger(__name__)
+
+def _fields(cls, prefix=''):
+    """Map of names of sweepable fields of cls to (path, field).
+
+    Both field names and XML attribute names are accepted.
+    """
+    res = {}
+    for f in cls._fields:
+        if isinstance(f, (Quantity, fields.Float)):
+            for n in (f.field_name, f.attrname):
+                res[prefix + n] = ((prefix + f.field_name).split('.'), f)
+    return res
+
+_sweepable = dict(_fields(JetEngine), **_fields(JetEngine.Cruise, 'cruise.'))
+
+# Cruise mach and speed are alternatives; sweeping one drops the other.
+_alternatives = {'cruise.mach': 'cruise.speed', 'cruise.speed': 'cruise.mach'}
+
+class Parameter:
+    """Swept parameter.
+
+    :path: is list of attribute names leading to the field from the engine.
+    :unit: is unit of the values, or None for plain numbers.
+    :values: is array of values for grid sweep, or None if range.
+    :range: is (start, stop) for Latin hypercube sample.
+    """
+
+    def __init__(self, spec):
+        name, eq, value = spec.partition('=')
+        if not eq:
+            raise ValueError('parameter must be NAME=START:STOP[:N] or NAME=V1,V2,…')
+        try:
+            self.path, field = _sweepable[name]
+        except KeyError:
+            raise ValueError("'{}' is not a numeric jet or cruise attribute".format(
+                name)) from None
+        self.name = '.'.join(self.path)
+        if ':' in value:
+            r = value.split(':')
+            if len(r) not in (2, 3):
+                raise ValueError('range must be START:STOP[:N]')
+            start, stop = self._parse(field, r[:2])
+            self.range = (start, stop)
+            self.values = None if len(r) == 2 else numpy.linspace(start, stop, int(r[2]))
+        else:
+            self.values = numpy.array(self._parse(field, value.split(',')))
+            self.range = None
+
+    def _parse(self, field, strings):
+        values = [field.parse_value(s.strip()) for s in strings]
+        if isinstance(values[0], U.Quantity):
+            self.unit = values[0].units
+            return [v.m_as(values[0].units) for v in values]
+        self.unit = None
+        return values
+
+    def sample(self, u):
+        """Values at quantiles u (array in [0, 1))."""
+        if self.range is not None:
+            return self.range[0] + u * (self.range[1] - self.range[0])
+        return self.values[(u * len(self.values)).astype(int)]
+
+    def set(self, engine, value):
+        obj = engine
+        for a in self.path[:-1]:
+            obj = getattr(obj, a)
+        setattr(obj, self.path[-1],
+                float(value) if self.unit is None else U.Quantity(value, self.unit))
+
+    def __repr__(self):
+        return 'Parameter({!r})'.format(self.name)
+
+    def header(self):
+        if self.unit is None:
+            return self.name
+        return '{}[{:~}]'.format(self.name, self.unit)
+
+def grid(params):
+    """Array of all combinations of values of params, one row per variant."""
+    for p in params:
+        if p.values is None:
+            raise ValueError('{}: number of values of range must be given '
+                    'unless sampling'.format(p.name))
+    mesh = numpy.meshgrid(*(p.values for p in params), indexing='ij')
+    return numpy.stack([m.ravel() for m in mesh], axis=1)
+
+def latin_hypercube(params, n, seed=None):
+    """Array of n variants sampling params by Latin hypercube."""
+    rng = numpy.random.default_rng(seed)
+    u = (numpy.array([rng.permutation(n) for p in params]).T
+            + rng.random((n, len(params)))) / n
+    return numpy.stack([p.sample(u[:, i]) for i, p in enumerate(params)],
+            axis=1)
+
+# State of worker process: the engine, the parameters and the table domains.
+_engine = None
+_params = None
+_domains = None
+
+def _init(engine, params, domains):
+    global _engine, _params, _domains
+    _engine = JetEngine.parse(engine)
+    for p in params:
+        if p.name in _alternatives:
+            setattr(_engine.cruise, _alternatives[p.name].split('.')[1], None)
+    _params = params
+    _domains = domains
+
+def _evaluate(variants):
+    """Return v_ex [m/s], dry and idle thrust tables for rows of variants."""
+    mach, alt = (numpy.asarray(d) for d in _domains)
+    n = len(variants)
+    v_ex = numpy.full(n, numpy.nan)
+    dry = numpy.full((n, len(mach), len(alt)), numpy.nan)
+    idle = numpy.full((n, len(mach), len(alt)), numpy.nan)
+    for i, row in enumerate(variants):
+        try:
+            for p, v in zip(_params, row):
+                p.set(_engine, v)
+            v_ex[i] = _engine._thrust_params().v_ex
+            dry[i] = _engine.dry_thrust_table(mach[:, None], alt[None, :])
+            idle[i] = _engine.idle_thrust_table(mach[:, None], alt[None, :])
+        except Exception as e:
+            _log.warning('variant %s: %s: %s', ', '.join(
+                '{}={}'.format(p.name, v) for p, v in zip(_params, row)),
+                type(e).__name__, e)
+    return v_ex, dry, idle
+
+def run(engine, params, variants, domains, workers=None):
+    """Evaluate variants of engine.
+
+    :engine: is the jet XML.
+    :params: is list of Parameter.
+    :variants: is array of their values, one row per variant.
+    :domains: is (Mach numbers, altitudes in ft) of the tables.
+    :workers: is number of processes, default is number of CPUs.
+
+    Returns (v_ex, dry, idle) arrays, with NaN for variants that failed.
+    """
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(variants) < 2:
+        _init(engine, params, domains)
+        return _evaluate(variants)
+    chunks = numpy.array_split(variants,
+            min(len(variants), workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+            initializer=_init, initargs=(engine, params, domains)) as pool:
+        futures = [profiling.submit(pool, _evaluate, c) for c in chunks]
+        results = [profiling.result(f) for f in futures]
+    return tuple(numpy.concatenate(r) for r in zip(*results))
+
+def write_npz(output, params, variants, domains, v_ex, dry, idle):
+    numpy.savez(output,
+            params=numpy.array([p.name for p in params]),
+            units=numpy.array(['' if p.unit is None else '{:~}'.format(p.unit)
+                for p in params]),
+            values=variants,
+            mach=numpy.asarray(domains[0]), alt=numpy.asarray(domains[1]),
+            v_ex=v_ex, dry=dry, idle=idle)
+
+def write_csv(output, params, variants, domains, v_ex, dry, idle):
+    cells = ['{:g}@{:g}'.format(m, a) for m in domains[0] for a in domains[1]]
+    with open(output, 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        w.writerow([p.header() for p in params] + ['v_ex[m/s]']
+                + ['dry@' + c for c in cells] + ['idle@' + c for c in cells])
+        for i in range(len(variants)):
+            w.writerow([repr(float(v)) for v in numpy.concatenate((variants[i],
+                [v_ex[i]], dry[i].ravel(), idle[i].ravel()))])
+
+def _parameter(spec):
+    try:
+        return Parameter(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def _range(string):
+    b, e, n = string.split(':')
+    return numpy.linspace(float(b), float(e), int(n)).tolist()
+
+def _find_jet(xml, index):
+    """The index-th jet in model xml, which may be airplane or single jet."""
+    if ElementTree.fromstring(xml).tag == JetEngine.meta.tagname:
+        if index != 1:
+            raise ValueError('model is single jet')
+        return xml
+    jets = Airplane.parse(xml).jets
+    if not 1 <= index <= len(jets):
+        raise ValueError('model has {} jets'.format(len(jets)))
+    return jets[index - 1].render()
+
+def _check(engine, params):
+    if JetEngine.parse(engine).cruise is None:
+        for p in params:
+            if p.path[0] == 'cruise':
+                raise ValueError('{}: the jet has no cruise'.format(p.name))
+
+def main(args=None):
+    p = argparse.ArgumentParser(prog='yaamatic sweep',
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('model',
+            help="Model template with the engine; either airplane or jet.")
+    p.add_argument('-D', '--define', type=_Definition, action='append',
+            default=[],
+            help="Define value that will be made available in the model "
+                +"template.")
+    p.add_argument('--jet', type=int, default=1,
+            help="Which jet of the airplane to sweep, from 1 (default %(default)s)")
+    p.add_argument('-p', '--param', type=_parameter, action='append',
+            required=True,
+            help="Swept attribute of the jet or its cruise (as cruise.NAME), "
+                +"as NAME=START:STOP:N for N values evenly spaced from START "
+                +"to STOP or NAME=V1,V2,… for the listed values. Values may "
+                +"have units; default is the attribute's unit. All "
+                +"combinations are evaluated.")
+    p.add_argument('--lhs', type=int, metavar='N',
+            help="Evaluate N variants sampled by Latin hypercube instead of "
+                +"all combinations. Ranges may omit N then.")
+    p.add_argument('--seed', type=int,
+            help="Random seed for --lhs.")
+    p.add_argument('--mach', type=_range, default='0:1.4:15',
+            help="Mach numbers of the tables as START:STOP:N (default %(default)s)")
+    p.add_argument('--alt', type=_range, default='-5000:50000:12',
+            help="Density altitudes in ft of the tables as START:STOP:N "
+                +"(default %(default)s)")
+    p.add_argument('-j', '--jobs', type=int,
+            help="Number of worker processes, default is number of processors.")
+    p.add_argument('-v', '--verbose', action='count', default=0,
+            help="Report progress on standard error.")
+    p.add_argument('--profile', action='store_true',
+            help="Report time spent and number of calls of the atmosphere "
+                +"and thrust functions on standard error.")
+    p.add_argument('-o', '--output', required=True,
+            help="Output file; .csv for CSV, otherwise NumPy .npz with arrays "
+                +"params, units, values (variant × param), mach, alt, "
+                +"v_ex (m/s), dry and idle (variant × mach × alt).")
+    a = p.parse_args(args)
+
+    logging.basicConfig(format='%(name)s: %(message)s',
+            level=logging.WARNING - 10 * a.verbose)
+    if a.profile:
+        profiling.enable()
+
+    try:
+        engine = _find_jet(batch.preprocess(batch.Job(a.model, dict(a.define),
+            None, None, None)), a.jet)
+        _check(engine, a.param)
+        if a.lhs is not None:
+            variants = latin_hypercube(a.param, a.lhs, a.seed)
+        else:
+            variants = grid(a.param)
+    except ValueError as e:
+        p.error(str(e))
+
+    domains = (a.mach, a.alt)
+    _log.info('evaluating %d variants', len(variants))
+    with profiling.stage('sweep'):
+        v_ex, dry, idle = run(engine, a.param, variants, domains, a.jobs)
+    failed = numpy.isnan(v_ex).sum()
+    if failed:
+        _log.warning('%d of %d variants failed', failed, len(variants))
+    write = write_csv if a.output.endswith('.csv') else write_npz
+    write(a.output, a.param, variants, domains, v_ex, dry, idle)
+    if a.profile:
+        profiling.report(sys.stderr)
+    return 1 if failed else 0
@@ -1,22 +1,146 @@
 from genshi import template
+import collections
+import copyreg
+import filecmp
+import genshi
+import hashlib
+import io
+import marshal
 import os
 import os.path
+import pickle
+import sys
+import types
 
-from .units import U, Q
+from . import profiling
 
-xml_loader = template.TemplateLoader([
+def _dumps(state):
+    f = io.BytesIO()
+    p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    # Templates with <?python?> blocks hold code objects. Marshal can store
+    # them, and the key includes the Python version, so it reads them back.
+    p.dispatch_table = dict(copyreg.dispatch_table)
+    p.dispatch_table[types.CodeType] = lambda c: (marshal.loads,
+            (marshal.dumps(c),))
+    p.dump(state)
+    return f.getvalue()
+
+class Loader(template.TemplateLoader):
+    """TemplateLoader that can keep compiled templates in a cache.FileCache.
+
+    Set cache to use it. The templates are keyed by their source, so the
+    cached ones remain valid across runs and processes.
+    """
+    cache = None
+
+    def _instantiate(self, cls, fileobj, filepath, filename, encoding=None):
+        if self.cache is None:
+            return super()._instantiate(cls, fileobj, filepath, filename,
+                    encoding)
+        source = fileobj.read()
+        key = self.cache.key('template', cls.__name__, filepath, filename,
+                encoding, sys.version, genshi.__version__,
+                hashlib.sha256(source).hexdigest())
+        data = self.cache.get(key)
+        if data is not None:
+            tmpl = cls.__new__(cls)
+            tmpl.__setstate__(pickle.loads(data))
+            tmpl.loader = self
+            return tmpl
+        tmpl = super()._instantiate(cls, io.BytesIO(source), filepath,
+                filename, encoding)
+        # Not compiled yet, so includes are still resolved when generating.
+        state = tmpl.__getstate__()
+        state['loader'] = None
+        self.cache.put(key, _dumps(state))
+        return tmpl
+
+    def compile(self, fileobj, filename):
+        """Return markup template read from binary fileobj.
+
+        Unlike load, this does not search for the template, nor keep it in
+        memory, but still uses the cache.
+        """
+        return self._instantiate(template.MarkupTemplate, fileobj, None,
+                filename)
+
+_package_dir = os.path.dirname(os.path.abspath(__file__))
+
+xml_loader = Loader([
     '.',
-    template.loader.package('yaamatic', ''),
+    # Unless zipped, the package data is read as directory, so changes to
+    # the templates are noticed when auto_reload is set.
+    _package_dir if os.path.isdir(_package_dir)
+        else template.loader.package('yaamatic', ''),
     ])
 
-def load_stream(stream, definitions):
-    return template.MarkupTemplate(stream, filename=stream.name,
-            loader=xml_loader).generate(**definitions).render(method='xml')
+def loaded_files():
+    """Paths of template files xml_loader holds loaded."""
+    # Genshi has no public way to list them.
+    loaded = [xml_loader._cache[k] for k in list(xml_loader._cache)]
+    return [t.filepath for t in loaded
+            if t.filepath is not None and os.path.isfile(t.filepath)]
+
+def _preprocess(stream, definitions, filename):
+    return xml_loader.compile(stream, filename or stream.name).generate(
+            **definitions)
+
+def load_stream(stream, definitions, filename=None):
+    """Return model template read from binary stream preprocessed as str.
+
+    :filename: is name of the template in errors, default is stream.name.
+    """
+    return _preprocess(stream, definitions, filename).render(method='xml')
+
+def load_dom(stream, definitions, filename=None):
+    """Like load_stream, but return the model as DOM document.
+
+    The document is built from the events of the template as they are
+    generated, so the model is never held as text.
+    """
+    return to_dom(_preprocess(stream, definitions, filename))
 
-def generate(t_name, output, *dicts):
+def to_dom(events):
+    """Build DOM document from genshi markup events."""
+    from xml.dom import minidom
+
+    doc = minidom.Document()
+    node = doc
+    for kind, data, pos in events:
+        if kind is genshi.core.TEXT:
+            # Events may split text; the parser would join it.
+            if node.lastChild is not None and node.lastChild.nodeType == node.TEXT_NODE:
+                node.lastChild.data += data
+            elif node is not doc:
+                node.appendChild(doc.createTextNode(data))
+        elif kind is genshi.core.START:
+            tag, attrs = data
+            e = doc.createElementNS(tag.namespace, tag.localname)
+            for name, value in attrs:
+                e.setAttributeNS(name.namespace, name.localname, value)
+            node = node.appendChild(e)
+        elif kind is genshi.core.END:
+            node = node.parentNode
+        elif kind is genshi.core.COMMENT:
+            node.appendChild(doc.createComment(data))
+        elif kind is genshi.core.PI:
+            node.appendChild(doc.createProcessingInstruction(*data))
+    return doc
+
+def preload(cache, *t_names):
+    """Set cache of xml_loader and load the templates t_names into it.
+
+    Used to initialize worker processes.
+    """
+    xml_loader.cache = cache
+    for t in t_names:
+        xml_loader.load(t)
+
+def _generate(t_name, *dicts):
     c = template.Context()
     c.update({
         'frange': frange,
+        'refine': refine,
         'table1': table1,
         'table2': table2,
         })
@@ -24,26 +148,251 @@ def generate(t_name, output, *dicts):
         c.update(d)
 
     tmpl = xml_loader.load(t_name)
-    out = tmpl.generate(c)
+    return tmpl.generate(c)
 
+def _makedirs(output):
     if os.path.dirname(output):
         os.makedirs(os.path.dirname(output), exist_ok=True)
-    
-    out.render(method='xml', encoding='utf-8', out=open(output, 'wb'))
+
+def stream(t_name, *dicts):
+    """Render template t_name with data dicts as genshi stream for write.
+
+    Nothing is computed until it is written out.
+    """
+    return _generate(t_name, *dicts)
+
+def render(t_name, *dicts):
+    """Render template t_name with data dicts and return it as bytes."""
+    return _generate(t_name, *dicts).render(method='xml', encoding='utf-8')
+
+def write(output, data):
+    """Write output of render or stream to file output.
+
+    A stream is rendered into the file as it is produced, so the content is
+    never all in memory. The file is not touched if it already has that
+    content.
+    """
+    if isinstance(data, bytes):
+        try:
+            with open(output, 'rb') as f:
+                if f.read() == data:
+                    return
+        except FileNotFoundError:
+            pass
+    _makedirs(output)
+
+    # Written to temporary file first, so failure does not leave
+    # a truncated output behind.
+    tmp = os.path.join(os.path.dirname(output),
+            '.{}.{}'.format(os.path.basename(output), os.getpid()))
+    try:
+        with open(tmp, 'wb') as f:
+            if isinstance(data, bytes):
+                f.write(data)
+            else:
+                data.render(method='xml', encoding='utf-8', out=f)
+        if (not isinstance(data, bytes) and os.path.exists(output)
+                and filecmp.cmp(tmp, output, shallow=False)):
+            os.unlink(tmp)
+        else:
+            os.replace(tmp, output)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+_digests = {}
+
+def digest(t_name):
+    """Digest of content of template t_name as found by xml_loader."""
+    for d in xml_loader.search_path:
+        if callable(d):
+            # Package data; does not change while we run.
+            try:
+                filepath, _, f, _ = d(t_name)
+            except IOError:
+                continue
+            if (filepath, None) not in _digests:
+                with f:
+                    _digests[filepath, None] = hashlib.sha256(f.read()).hexdigest()
+            return _digests[filepath, None]
+        filepath = os.path.join(d, t_name)
+        try:
+            mtime = os.stat(filepath).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        if (filepath, mtime) not in _digests:
+            with open(filepath, 'rb') as f:
+                _digests[filepath, mtime] = hashlib.sha256(f.read()).hexdigest()
+        return _digests[filepath, mtime]
+    raise template.TemplateNotFound(t_name, xml_loader.search_path)
 
 def frange(b, e, n):
     for i in range(n + 1):
         yield b * ((n - i)/n) + e * (i/n)
 
+def vectorized(fn):
+    """Mark fn as able to evaluate a whole table in one call.
+
+    The table helpers then call it once with NumPy arrays, the rows as
+    a column vector and the columns as a row vector, and expect the
+    broadcast result back. Functions not marked are called once per cell.
+    """
+    fn.vectorized = True
+    return fn
+
+def keyed(fn, key):
+    """Vectorized fn whose values are determined by hashable key.
+
+    Tables of functions with equal keys over equal domains, and their
+    breakpoints chosen by refine, are computed once and then reused, as
+    long as they fit in table_cache_cells.
+    """
+    def call(*args):
+        return fn(*args)
+    call.vectorized = True
+    call.key = key
+    return call
+
+# Limit on the number of cells of the tables kept for reuse, in this
+# process; a cell takes 8 bytes.
+table_cache_cells = 2**20
+
+# Tables of keyed functions and breakpoints chosen for them by refine, by
+# key and domains, least recently used first, with their number of cells.
+_tables = collections.OrderedDict()
+_table_cells = 0
+_table_stats = collections.Counter(hits=0, misses=0)
+
+def table_stats():
+    """Counts of tables of keyed functions reused (hits) and computed."""
+    return dict(_table_stats)
+
+profiling.add_stats(lambda: {'templates.tables.' + k: v
+    for k, v in _table_stats.items()})
+
+def clear_tables():
+    """Forget the tables kept for reuse."""
+    global _table_cells
+    _tables.clear()
+    _table_cells = 0
+
+def _recall(key):
+    try:
+        value, cells = _tables[key]
+    except KeyError:
+        _table_stats['misses'] += 1
+        return None
+    _tables.move_to_end(key)
+    _table_stats['hits'] += 1
+    return value
+
+def _remember(key, value, cells):
+    global _table_cells
+    if cells > table_cache_cells:
+        return
+    _tables[key] = (value, cells)
+    _table_cells += cells
+    while _table_cells > table_cache_cells:
+        _table_cells -= _tables.popitem(last=False)[1][1]
+
+def _evaluate(fn, *domains):
+    if getattr(fn, 'vectorized', False):
+        # Not needed for just preprocessing the model
+        import numpy
+
+        key = getattr(fn, 'key', None)
+        if key is not None:
+            key = (key,) + tuple(tuple(d) for d in domains)
+            v = _recall(key)
+            if v is not None:
+                return v
+        with profiling.stage('tables'):
+            v = numpy.broadcast_to(
+                    fn(*numpy.ix_(*(numpy.asarray(d, dtype=float) for d in domains))),
+                    tuple(len(d) for d in domains))
+        if key is not None:
+            _remember(key, v, v.size)
+        return v
+    elif len(domains) == 1:
+        return (fn(r) for r in domains[0])
+    else:
+        return ([fn(r, c) for c in domains[1]] for r in domains[0])
+
+# The tables are generators of lines, which genshi formats as it writes
+# them out, so large tables are not built up by concatenating strings.
+# The values themselves are computed all at once (see _evaluate).
+
 def table1(fn, rowdom):
-    res = ''
-    for r in rowdom:
-        res += ' ' * 12 + ' {:11.5g} {:11.5g}'.format(r, fn(r)) + '\n'
+    rowdom = list(rowdom)
+    for r, v in zip(rowdom, _evaluate(fn, rowdom)):
+        yield ' ' * 12 + ' {:11.5g} {:11.5g}'.format(r, v) + '\n'
 
 def table2(fn, rowdom, coldom):
+    rowdom = list(rowdom)
     coldom = list(coldom)
-    res = ' ' * 24 + ''.join((' {:11.5g}'.format(c) for c in coldom)) + '\n'
-    for r in rowdom:
-        res += ' ' * 12 + ' {:11.5g}'.format(r) + ''.join(
-                (' {:11.5g}'.format(fn(r, c)) for c in coldom)) + '\n'
+    yield ' ' * 24 + ''.join((' {:11.5g}'.format(c) for c in coldom)) + '\n'
+    for r, row in zip(rowdom, _evaluate(fn, rowdom, coldom)):
+        yield ' ' * 12 + ' {:11.5g}'.format(r) + ''.join(
+                (' {:11.5g}'.format(v) for v in row)) + '\n'
+
+def _interpolate(v, x, keep):
+    """Values v interpolated along first axis from just the rows keep.
+
+    :v: is array of values at coordinates x along the first axis.
+    :keep: is boolean mask of rows of v used; must include the first and
+    last one.
+    """
+    import numpy
+
+    k = numpy.flatnonzero(keep)
+    s = numpy.clip(numpy.searchsorted(k, numpy.arange(len(x)), side='right') - 1,
+            0, len(k) - 2)
+    i0 = k[s]
+    i1 = k[s + 1]
+    t = ((x - x[i0]) / (x[i1] - x[i0])).reshape((-1,) + (1,) * (v.ndim - 1))
+    return v[i0] * (1 - t) + v[i1] * t
+
+def _select(v, x, tol):
+    """Mask of rows of v needed to interpolate the rest within tol."""
+    import numpy
+
+    keep = numpy.zeros(len(x), dtype=bool)
+    keep[[0, -1]] = True
+    while True:
+        err = abs(_interpolate(v, x, keep) - v).reshape(len(x), -1).max(axis=1)
+        worst = err.argmax()
+        if err[worst] <= tol:
+            return keep
+        keep[worst] = True
+
+def refine(fn, rowdom, coldom, tol):
+    """Choose breakpoints of table of fn from candidate domains.
+
+    Returns (rows, columns), subsets of rowdom and coldom such that linear
+    interpolation in the table reproduces fn at all the candidate points
+    within tol, so the domains should be dense. The breakpoints are placed
+    where fn curves; on the straight parts, few of them are used.
+
+        ${table2(fn, *refine(fn, frange(0., 1.4, 140), range(-5000, 50001, 500), 1e-3))}
+    """
+    import numpy
+
+    rowdom = numpy.asarray(list(rowdom), dtype=float)
+    coldom = numpy.asarray(list(coldom), dtype=float)
+    key = getattr(fn, 'key', None)
+    if key is not None:
+        key = ('refine', key, tuple(rowdom), tuple(coldom), tol)
+        res = _recall(key)
+        if res is not None:
+            return res
+    with profiling.stage('refine'):
+        v = numpy.array(list(_evaluate(fn, rowdom, coldom)), dtype=float)
+        # Each step of bilinear interpolation is a convex combination, so
+        # errors of tol/2 in rows and in columns add up to at most tol.
+        rows = _select(v, rowdom, tol/2)
+        cols = _select(v.T, coldom, tol/2)
+    res = rowdom[rows].tolist(), coldom[cols].tolist()
+    if key is not None:
+        _remember(key, res, len(res[0]) + len(res[1]))
     return res
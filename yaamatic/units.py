@@ -1,18 +1,58 @@
 ﻿import dexml.fields
+import functools
 import pint
 import re
 
-U = pint.UnitRegistry(
-        on_redefinition='ignore' # I need to redefine hour to be abbreviated h
-        )
+from . import cache
+from . import profiling
+
+try:
+    U = pint.UnitRegistry(
+            on_redefinition='ignore', # I need to redefine hour to be abbreviated h
+            # Parsing the unit definitions is most of the start-up time, so
+            # keep them parsed.
+            cache_folder=cache.units_dir)
+except TypeError:
+    # Pint < 0.18 can't keep them.
+    U = pint.UnitRegistry(on_redefinition='ignore')
 Q = U.Quantity
 
+# Quantities unpickled in worker processes must belong to the same registry
+pint.set_application_registry(U)
+
 # Fix hour: correct abbreviation for hour is h, so override the planck
 # constant:
 U.define('hour = 60 * minute = h = hr')
 
+# The same few unit strings and values are parsed over and over, for every
+# element of a model and every substitution into a template, so parsing
+# is memoized. The quantities are shared, so they must not be modified in
+# place.
+
+_cache_size = 4096
+
+@functools.lru_cache(maxsize=_cache_size)
+def parse_expression(string):
+    """U(string), memoized."""
+    return U(string)
+
+@functools.lru_cache(maxsize=_cache_size)
+def parse_units(string):
+    """U.parse_units(string), memoized."""
+    return U.parse_units(string)
+
+def cache_stats():
+    """Hit and miss counts of the parsing caches, by name."""
+    return {f.__name__: f.cache_info() for f in (
+        parse_expression, parse_units, _parse_value)}
+
+profiling.add_stats(lambda: {'units.{}.{}'.format(n, k): getattr(i, k)
+        for n, i in cache_stats().items() for k in ('hits', 'misses')})
+
 # Add method for easier substitution into templates using () (call operator)
 def in_unit(self, unit):
+    if isinstance(unit, str):
+        unit = parse_units(unit)
     return str(self.to(unit).magnitude)
 Q.__call__ = in_unit
 
@@ -22,6 +62,16 @@ Q.__str__ = lambda self: in_unit(self, ())
 
 _q_re = re.compile(r'([+-]?[0-9]*(?:\.[0-9]*)?)\s*(.*)')
 
+@functools.lru_cache(maxsize=_cache_size)
+def _parse_value(val, unit):
+    """Quantity val, in unit if it has none; None if not of its dimension."""
+    m = _q_re.match(val)
+    if m:
+        q = Q(float(m.group(1)), parse_units(m.group(2)) if m.group(2) else unit)
+        if q.dimensionality == unit.dimensionality:
+            return q
+    return None
+
 class Quantity(dexml.fields.Value):
     class arguments(dexml.fields.Value.arguments):
         unit = None
@@ -29,11 +79,11 @@ class Quantity(dexml.fields.Value):
     def __init__(self, **kw):
         super(Quantity, self).__init__(**kw)
         if isinstance(self.default, str):
-            self.default = U(self.default)
+            self.default = parse_expression(self.default)
         if self.default is not None and self.unit is None:
-            self.unit = Q(1, self.default)
+            self.unit = Q(1, self.default.units)
         if isinstance(self.unit, str):
-            self.unit = U(self.unit)
+            self.unit = parse_expression(self.unit)
         if not isinstance(self.unit, Q):
             raise TypeError(
                     'unit ({:P~}) must be quantity or string convertible to quantity',
@@ -46,11 +96,9 @@ class Quantity(dexml.fields.Value):
             raise ValueError('Quantity field requires unit or default')
 
     def parse_value(self, val):
-        m = _q_re.match(val)
-        if m:
-            q = Q(float(m.group(1)), m.group(2) or self.unit)
-            if q.dimensionality == self.unit.dimensionality:
-                return q
+        q = _parse_value(val, self.unit.units)
+        if q is not None:
+            return q
         raise ValueError("Value ‘{}’ can't be converted to {:P}".format(
             val, self.unit.dimensionality))
 
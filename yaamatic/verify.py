@@ -0,0 +1,82 @@
+"""Verification of the generated thrust tables.
+
+JSBSim interpolates the tables linearly between the breakpoints. check
+reads the tables back from an engine file and compares that interpolation
+with the thrust functions of the engine on a grid several times denser,
+so the error includes both the interpolation and the rounding of the
+printed values. Everything is evaluated on whole arrays, so checking
+takes a fraction of the time rendering the file does.
+"""
+
+from xml.etree import ElementTree
+import collections
+import numpy
+
+Error = collections.namedtuple('Error', ['table', 'max', 'rms'])
+
+# Functions of the engine file to JetEngine methods they tabulate
+_functions = {
+        'IdleThrust': 'idle_thrust_table',
+        'MilThrust': 'dry_thrust_table',
+        }
+
+def read_tables(data):
+    """Return the two-dimensional tables in engine file data.
+
+    The result is dict of function names to (rows, columns, values) arrays.
+    """
+    res = {}
+    for f in ElementTree.fromstring(data).iter('function'):
+        t = f.find('table/tableData')
+        if t is None:
+            continue
+        lines = [l.split() for l in t.text.splitlines() if l.strip()]
+        cols = numpy.array(lines[0], dtype=float)
+        rows = numpy.array(lines[1:], dtype=float)
+        res[f.get('name')] = (rows[:, 0], cols, rows[:, 1:])
+    return res
+
+def _dense(b, n):
+    """Breakpoints b with each interval split into n."""
+    t = numpy.arange(n) / n
+    return numpy.append((b[:-1, None] + (b[1:] - b[:-1])[:, None] * t).ravel(),
+            b[-1])
+
+def _segment(b, x):
+    i = numpy.clip(numpy.searchsorted(b, x, side='right') - 1, 0, len(b) - 2)
+    return i, numpy.clip((x - b[i]) / (b[i + 1] - b[i]), 0, 1)
+
+def bilinear(rows, cols, values, r, c):
+    """Interpolate table like JSBSim at all combinations of r and c.
+
+    Outside the table, the values at its edge are used.
+    """
+    i, tr = _segment(rows, r)
+    j, tc = _segment(cols, c)
+    tr = tr[:, None]
+    tc = tc[None, :]
+    return (values[numpy.ix_(i, j)] * (1 - tr) * (1 - tc)
+            + values[numpy.ix_(i + 1, j)] * tr * (1 - tc)
+            + values[numpy.ix_(i, j + 1)] * (1 - tr) * tc
+            + values[numpy.ix_(i + 1, j + 1)] * tr * tc)
+
+def check(engine, data, density=8):
+    """Return list of Error of the thrust tables in engine file data.
+
+    :engine: is the JetEngine the file was generated from.
+    :density: is number of points checked in each interval between
+    breakpoints along each axis.
+    """
+    res = []
+    for name, (rows, cols, values) in read_tables(data).items():
+        if name not in _functions:
+            continue
+        r = _dense(rows, density)
+        c = _dense(cols, density)
+        exact = numpy.broadcast_to(
+                getattr(engine, _functions[name])(r[:, None], c[None, :]),
+                (len(r), len(c)))
+        err = bilinear(rows, cols, values, r, c) - exact
+        res.append(Error(name, float(abs(err).max()),
+            float(numpy.sqrt((err ** 2).mean()))))
+    return res